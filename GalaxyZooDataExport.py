@@ -1,6 +1,10 @@
-import numpy as np
 import pandas as pd
-from astroquery.sdss import SDSS
+from panoptes_io import json_loads
+from parquet_cache import load_classifications
+from reduction_state import ReductionState
+from result_builder import ResultBuilder
+from sdss_queries import get_sdss_data, SDSSCache, QueryExecutor, SDSSQueryError, default_chunk_size
+from instrumentation import Instrumentation, profiled
 
 def get_stats(choices_dict):
     # Input is a dict with classification options as the keys, and each option's count as integer values
@@ -12,122 +16,228 @@ def get_stats(choices_dict):
 
     return stats_dict
 
+# Classification options in the workflow
+choice_names=['Spiral','Elliptical','Merger','Star/artifact']
+
+# Columns of the raw export needed by parse_votes, and the parsed columns the export uses
+raw_columns=['classification_id','subject_ids','annotations','subject_data']
+parsed_columns=['classification_id','subject_ids','gx_id','choice']
+
+def parse_votes(chunk):
+    # Turns a chunk of raw classifications into one row per classification, with the
+    # subject id, the galaxy's SDSS id (gx_id) and the option chosen (None if no choice)
+    # SDSS galaxy id comes from the subject metadata, specifically the image name
+    image_files=[list(json_loads(subject_data).values())[0]['image_file'] for subject_data in chunk['subject_data']]
+    choices=[json_loads(annotations)[0]['value'] for annotations in chunk['annotations']]
+    return pd.DataFrame({'classification_id' : chunk['classification_id'],
+                         'subject_ids'       : chunk['subject_ids'],
+                         'gx_id'             : [image_file[:-5] for image_file in image_files],
+                         'choice'            : choices},
+                        index=chunk.index)
+
+def count_votes(workflow_data):
+    # Counts the number of each type of classification for every galaxy. Returns a dataframe
+    # indexed by subject id, with the galaxy's SDSS id (gx_id) and a column of counts per option
+    subject_ids=pd.Index(workflow_data['subject_ids'].unique(), name='subject_ids')
+    gx_ids=workflow_data.groupby('subject_ids')['gx_id'].first()
+    counts=pd.crosstab(workflow_data['subject_ids'], workflow_data['choice'])
+    votes=pd.DataFrame({'gx_id':gx_ids.reindex(subject_ids)}, index=subject_ids)
+    for name in choice_names:
+        if name in counts:
+            votes[name]=counts[name].reindex(subject_ids).fillna(0).astype(int)
+        else:
+            votes[name]=0
+    return votes
+
+def merge_votes(tallies):
+    # Merges a list of vote tables from count_votes (None entries are skipped)
+    tallies=[tally for tally in tallies if tally is not None and len(tally)]
+    agg=dict([('gx_id','first')]+[(name,'sum') for name in choice_names])
+    return pd.concat(tallies).groupby(level=0, sort=False).agg(agg)
+
+result_columns=['Galaxy ID', 'N_Votes', 'p_ell', 'p_sp', 'p_mrg', 'p_oth', 'g_mag', 'r_mag', 'z']
+
+def build_tables(votes, sdss_data):
+    # Builds two tables, one for our classification data, and one for the data from
+    # the original Galaxy Zoo for comparison, from the vote counts and the SDSS data
+    # for each galaxy. Returns (workflow_results, zoo_results), with one row per subject.
+    workflow_results=ResultBuilder(result_columns)
+    zoo_results=ResultBuilder(result_columns)
+
+    # Line the SDSS data up with the subjects. Several subjects can show the same
+    # galaxy (e.g. if it was uploaded again), so this is done by position rather than
+    # looking each galaxy up by its objid.
+    sdss_rows=sdss_data.reindex([str(gx_id) for gx_id in votes['gx_id']]).to_dict('records')
+
+    # Iterate through each galaxy to find its stats
+    for gx_id,counts,sdss_row in zip(votes['gx_id'],votes[choice_names].values,sdss_rows):
+        choices=dict(zip(choice_names,[int(count) for count in counts]))
+        stats_dict=get_stats(choices)
+        g_mag=round(sdss_row['modelmag_g'],4)
+        r_mag=round(sdss_row['modelmag_r'],4)
+        z=round(sdss_row['z'],4)
+
+        workflow_results.append({'Galaxy ID':gx_id,
+                            'N_Votes'    :sum(choices.values()),
+                            'p_ell'      :stats_dict['p_Elliptical'],
+                            'p_sp'       :stats_dict['p_Spiral'],
+                            'p_mrg'      :stats_dict['p_Merger'],
+                            'p_oth'      :stats_dict['p_Star/artifact'],
+                            'g_mag'      :g_mag,
+                            'r_mag'      :r_mag,
+                            'z'          :z
+                             })
+
+        # Original Galaxy Zoo voting data for the galaxy
+        zoo_results.append({'Galaxy ID':gx_id,
+                            'N_Votes'    :sdss_row['nvote_std'],
+                            'p_ell'      :sdss_row['p_el'],
+                            'p_sp'       :sdss_row['p_cs'],
+                            'p_mrg'      :sdss_row['p_mg'],
+                            'p_oth'      :sdss_row['p_dk'],
+                            'g_mag'      :g_mag,
+                            'r_mag'      :r_mag,
+                            'z'          :z
+                             })
+
+    # Miscellaneous formatting stuff
+
+    #Build each table, with appropriate columns grouped together
+    workflow_results=workflow_results.to_frame()
+    zoo_results=zoo_results.to_frame()
+
+    #Sort by Galaxy ID so we can quickly compare tables, and reset indices for neatness
+    workflow_results=workflow_results.sort_values('Galaxy ID').reset_index(drop=True)
+    zoo_results=zoo_results.sort_values('Galaxy ID').reset_index(drop=True)
+
+    # Typecast these columns as ints for neatness. Galaxies missing from the original
+    # Galaxy Zoo have no vote count, so those are left blank
+    for col in (['N_Votes']):
+        workflow_results[col] = workflow_results[col].astype(int)
+        zoo_results[col] = zoo_results[col].astype('Int64')
+    return workflow_results, zoo_results
+
 # Output file from Panoptes
 infile='galaxy-zoo-in-astronomy-101-classifications.csv'
 
 # Name of the specific workflow to grab and export.
 workflow_name = 'NU Highlights of Astronomy'
 
-all_raw_data=pd.read_csv(infile)
-
-# Grab data from our workflow
-workflow_data=all_raw_data.groupby('workflow_name').get_group(workflow_name)
-
-# This code chunk will print each user and how many classifications they did
-#for usr in workflow_data.user_name.unique():
-#    usr_data=workflow_data.groupby('user_name').get_group(usr)
-#    print '{:>13}'.format(usr[0:13]), len(usr_data),
-
-# Group galaxies by their galaxy ids
-galaxy_groups=workflow_data.groupby('subject_ids')
-
-
-# Create empty dataframes to fill, one for our classification data, and one for
-# the data from the original Galaxy Zoo for comparison
-workflow_results=pd.DataFrame({'Galaxy ID':[],
-                        'N_Votes':[],
-                        'p_ell':[],
-                        'p_sp':[],
-                        'p_mrg':[],
-                        'p_oth':[],
-                        'g_mag':[],
-                        'r_mag':[],
-                        'z':[]})
-
-zoo_results=pd.DataFrame({'Galaxy ID':[],
-                        'N_Votes':[],
-                        'p_ell':[],
-                        'p_sp':[],
-                        'p_mrg':[],
-                        'p_oth':[],
-                        'g_mag':[],
-                        'r_mag':[],
-                        'z':[]})
-
-# Iterate through each id to find that galaxy's stats
-for gx in workflow_data.subject_ids.unique():
-    subject_classifications=galaxy_groups.get_group(gx)
-
-    # Get SDSS galaxy id from metadata, specifically image name
-    image_file=pd.read_json(subject_classifications.iloc[0]['subject_data'])[gx]['image_file']
-    gx_id=image_file[:-5]
-    #display(Image(filename='Activity2Images/'+image_file, width=200, height=200))
-
-    # Count number of each type of classification, and get stats based on those numbers
-    choices={'Spiral':0,'Elliptical':0,'Merger':0,'Star/artifact':0}
-    for index,row in subject_classifications.iterrows():
-        choice=str(pd.read_json(row['annotations'])['value'].values[0])
-        if choice != 'nan':
-            choices[choice]+=1
-    stats_dict=get_stats(choices)
-
-    # Perform SDSS SQL queries to determine magnitude and redshift for this galaxy.
-    mag_sql_query='select top 1 modelmag_g,modelmag_r from photoobjall where objid='+gx_id
-    z_sql_query='select top 1 z from specobjall where bestobjid='+gx_id
-    zooVotes_sql_query='select top 1 nvote_std,p_el,p_cs,p_mg,p_dk from zooVotes where objid='+gx_id
-
-    mags=SDSS.query_sql(mag_sql_query).to_pandas()
-
-    # In case galaxy doesn't have a measured redshift, need to catch resulting SQL error
-    try:
-        z=SDSS.query_sql(z_sql_query)[0][0]
-    except:
-        z=np.nan # If no redshift, flag value
-        pass
-
-    new_workflow_row=pd.DataFrame({'Galaxy ID':[gx_id],
-                        'N_Votes'    :[sum(choices.values())],
-                        'p_ell'      :[stats_dict['p_Elliptical']],
-                        'p_sp'       :[stats_dict['p_Spiral']],
-                        'p_mrg'      :[stats_dict['p_Merger']],
-                        'p_oth'      :[stats_dict['p_Star/artifact']],
-                        'g_mag'      :[round(mags['modelmag_g'].values[0],4)],
-                        'r_mag'      :[round(mags['modelmag_r'].values[0],4)],
-                        'z'          :[round(z,4)]
-                         })
-    workflow_results=pd.concat([workflow_results, new_workflow_row])
-
-
-    # Grabs original Galaxy Zoo voting data for the galaxy
-    zooVotes=SDSS.query_sql(zooVotes_sql_query).to_pandas()
-
-    new_zoo_row=pd.DataFrame({'Galaxy ID':[gx_id],
-                        'N_Votes'    :[zooVotes['nvote_std'].values[0]],
-                        'p_ell'      :[zooVotes['p_el'].values[0]],
-                        'p_sp'       :[zooVotes['p_cs'].values[0]],
-                        'p_mrg'      :[zooVotes['p_mg'].values[0]],
-                        'p_oth'      :[zooVotes['p_dk'].values[0]],
-                        'g_mag'      :[round(mags['modelmag_g'].values[0],4)],
-                        'r_mag'      :[round(mags['modelmag_r'].values[0],4)],
-                        'z'          :[round(z,4)]
-                         })
-    zoo_results=pd.concat([zoo_results, new_zoo_row])
-
-# Miscellaneous formatting stuff
-
-#Rearrange table to group appropriate columns together
-workflow_results=workflow_results[['Galaxy ID', 'N_Votes', 'p_ell', 'p_sp', 'p_mrg', 'p_oth', 'g_mag', 'r_mag', 'z']]
-zoo_results=zoo_results[['Galaxy ID', 'N_Votes', 'p_ell', 'p_sp', 'p_mrg', 'p_oth', 'g_mag', 'r_mag', 'z']]
-
-#Sort by Galaxy ID so we can quickly compare tables, and reset indices for neatness
-workflow_results=workflow_results.sort_values('Galaxy ID').reset_index(drop=True)
-zoo_results=zoo_results.sort_values('Galaxy ID').reset_index(drop=True)
-
-# Typecast these columns as ints for neatness
-for col in (['N_Votes']):
-    workflow_results[col] = workflow_results[col].astype(int)
-    zoo_results[col] = zoo_results[col].astype(int)
-
-# Stores both results dataframes as .csv's
-workflow_results.to_csv('Intro2Astro_GZ_workflow_output.csv')
-zoo_results.to_csv('Intro2Astro_GZ_zoo_output.csv')
+# Output files for our classification data, and for the original Galaxy Zoo's
+workflow_outfile='Intro2Astro_GZ_workflow_output.csv'
+zoo_outfile='Intro2Astro_GZ_zoo_output.csv'
+
+# Local cache of SDSS query results, so reruns only query galaxies we haven't seen.
+# Set to None to bypass the cache, or set refresh_sdss_cache to re-query everything.
+# Entries older than sdss_cache_max_age_days are re-queried and evicted, and once the
+# cache holds more than sdss_cache_max_entries lookups the oldest are evicted (None
+# for no limit).
+sdss_cache_file='sdss_cache.sqlite'
+refresh_sdss_cache=False
+sdss_cache_max_age_days=None
+sdss_cache_max_entries=None
+
+# Number of SDSS queries to run at once, and the average number of queries per second
+# allowed. Failed queries are retried up to sdss_max_retries times, with backoff.
+# If some still fail, nothing is written, since those galaxies would look like they
+# have no SDSS data. Set allow_sdss_failures to write the results anyway, with blanks
+# for the galaxies whose lookups failed (they're listed at the end of the run).
+# Each query looks up sdss_chunk_size galaxies; much more than the default and the
+# query gets too long for SkyServer to accept.
+sdss_max_workers=4
+sdss_query_rate=2.
+sdss_max_retries=4
+sdss_chunk_size=default_chunk_size
+allow_sdss_failures=False
+
+# In incremental mode, each galaxy's vote counts are saved to state_dir, and each
+# rerun only parses classifications added to the export since the last run
+incremental=False
+state_dir='reduction_state'
+
+# Where to cache the parsed export as Parquet, and how many processes to parse it
+# with (see parquet_cache.load_classifications). None for neither.
+parquet_cache_dir=None
+parse_workers=None
+
+# Instrumentation (see instrumentation.py), e.g. report_file='gzoo_report.json',
+# profile_file='gzoo.prof'. The report also has histograms of the SDSS query latencies.
+report_file=None
+trace_memory=False
+profile_file=None
+
+def main(infile=infile, workflow_name=workflow_name, workflow_outfile=workflow_outfile, zoo_outfile=zoo_outfile,
+         sdss_cache_file=sdss_cache_file, refresh_sdss_cache=refresh_sdss_cache,
+         sdss_cache_max_age_days=sdss_cache_max_age_days, sdss_cache_max_entries=sdss_cache_max_entries,
+         sdss_max_workers=sdss_max_workers,
+         sdss_query_rate=sdss_query_rate, sdss_max_retries=sdss_max_retries, sdss_chunk_size=sdss_chunk_size,
+         allow_sdss_failures=allow_sdss_failures, incremental=incremental,
+         state_dir=state_dir, parquet_cache_dir=parquet_cache_dir, parse_workers=parse_workers,
+         report_file=report_file, trace_memory=trace_memory, profile_file=profile_file,
+         instrumentation=None, sdss_client=None):
+    # Runs the whole export with the settings above (any of which can be overridden),
+    # recording each stage in instrumentation (a new Instrumentation if not given).
+    # sdss_client is passed on to get_sdss_data, e.g. a LocalSDSS to run offline.
+    # Returns the two results dataframes.
+    instr=instrumentation or Instrumentation('gzoo', trace_memory)
+    with profiled(profile_file):
+        # Grab data from our workflow, reading in only the columns we need
+        state=ReductionState(state_dir, 'gzoo', workflow_name, infile) if incremental else None
+        with instr.stage('load') as stage:
+            workflow_data=load_classifications(infile, workflow_name, parse_votes, raw_columns, parsed_columns,
+                                               after_id=state.last_id if state else None,
+                                               parquet_cache_dir=parquet_cache_dir, workers=parse_workers)
+            stage['rows']=len(workflow_data)
+
+        with instr.stage('aggregate') as stage:
+            votes=count_votes(workflow_data)
+            if incremental:
+                votes=merge_votes([state.load_table(dtype={'gx_id':str}), votes])
+                state.save(votes, workflow_data['classification_id'])
+            stage['rows']=len(votes)
+
+        # This code chunk will print each user and how many classifications they did
+        # (add 'user_name' to the columns kept by parse_votes first)
+        #for usr in workflow_data.user_name.unique():
+        #    usr_data=workflow_data.groupby('user_name').get_group(usr)
+        #    print '{:>13}'.format(usr[0:13]), len(usr_data),
+
+
+        # Look up magnitudes, redshifts and original Galaxy Zoo votes for every galaxy at once.
+        # Galaxies without a measured redshift come back with z=NaN.
+        sdss_cache=SDSSCache(sdss_cache_file, sdss_cache_max_age_days, sdss_cache_max_entries) if sdss_cache_file else None
+        sdss_executor=QueryExecutor(max_workers=sdss_max_workers, rate=sdss_query_rate, max_retries=sdss_max_retries)
+        try:
+            with instr.stage('sdss') as stage:
+                sdss_data=get_sdss_data(votes['gx_id'], client=sdss_client, cache=sdss_cache, refresh=refresh_sdss_cache,
+                                        executor=sdss_executor, chunk_size=sdss_chunk_size,
+                                        allow_failures=allow_sdss_failures)
+                stage['rows']=len(sdss_data)
+        except SDSSQueryError:
+            print(sdss_executor.stats.summary())
+            raise
+        finally:
+            instr.add_sdss_stats(sdss_executor.stats)
+            if sdss_cache is not None:
+                sdss_cache.close()
+
+        # Collect rows for two tables, one for our classification data, and one for
+        # the data from the original Galaxy Zoo for comparison
+        with instr.stage('tables') as stage:
+            workflow_results,zoo_results=build_tables(votes, sdss_data)
+            stage['rows']=len(workflow_results)
+
+        # Stores both results dataframes as .csv's
+        with instr.stage('write') as stage:
+            workflow_results.to_csv(workflow_outfile)
+            zoo_results.to_csv(zoo_outfile)
+            stage['rows']=len(workflow_results)+len(zoo_results)
+
+    # Report how long the SDSS queries took, and any galaxies whose lookups failed
+    print(sdss_executor.stats.summary())
+    if report_file:
+        instr.write(report_file)
+    return workflow_results, zoo_results
+
+if __name__=='__main__':
+    main()
@@ -1,115 +1,256 @@
-import pandas as pd
-import numpy as np
-
-
-'''
-1. Read in cvs
-2. get classification information
-3. get galaxy metadata (redshift, type)
-'''
-
-def get_classification(row):
-    # Takes an entire row (i.e. a single classification) and grabs
-    # the data relevant to the line identification
-    annotation_json=row['annotations']
-    metadata_json='['+row['metadata']+']'
-    json_object=pd.read_json(annotation_json)['value'][0]
-    metadata_object=pd.read_json(metadata_json)['subject_dimensions'][0][0]
-    nw=metadata_object['naturalWidth'] # Need this value in case students rescaled the window
-    if json_object and len(json_object[0])==7:# Error checks for a valid classification
-        xleft = json_object[0]['x']
-        width = json_object[0]['width']
-    else:
-        xleft = np.nan
-        width = np.nan
-    return {'xleft' : xleft, 'width' : width, 'nw': nw}
-
-def get_galaxy_metadata(subject_data_json):
-    json_object=pd.read_json(subject_data_json, orient='index')
-    ra = json_object['RA'].values[0]
-    dec = json_object['Dec'].values[0]
-    z = json_object['Redshift'].values[0]
-    galID = json_object['dr7objid'].values[0]
-    elliptical = bool(json_object['elliptical'].values[0])
-    return {'ra' : ra, 'dec' : dec, 'z' : z, 'galID' : galID, 'elliptical' : elliptical}
-
-def calc_lambda_central(classification_dict):
-    # Input is a classification dictionary with x_left, width, and natural window width
-    xleft = classification_dict['xleft']
-    width = classification_dict['width']
-    nw = classification_dict['nw']
-    xmin = int((108./1152.)*nw)# These hardcoded pixel values represent the default window sizes
-    xmax = int((1081./1152.)*nw)# If the actual window was sized differently, the factor of 'nw' scales the result appropriately
-    lambdamin = 380.
-    lambdamax = 500.
-    lamperpix = (lambdamax - lambdamin) / (xmax - xmin)
-    lambdacen = (xleft + (width / 2.) - xmin) * lamperpix + lambdamin
-    return lambdacen
-
-# Raw input file exported from the project builder
-infile = "intro2astro-hubbles-law-classifications.csv"
-
-# Name of output csv file where results will be stored
-outfile='NU_astro_120.csv'
-
-# Name of workflow to be analyzed
-workflow='NU Highlights of Astronomy'
-all_raw_data = pd.read_csv(infile)
-
-all_raw_data['classification'] = all_raw_data.apply(get_classification,axis=1)
-all_raw_data['galaxy_metadata'] = all_raw_data['subject_data'].apply(get_galaxy_metadata)
-all_raw_data['lambdacen'] = all_raw_data['classification'].apply(calc_lambda_central)
-all_raw_data['galaxy_id'] = [i['galID'] for i in all_raw_data['galaxy_metadata']]
-
-# Select the workflow we are concerned with
-section_groups = all_raw_data.groupby('workflow_name')
-workflow_data = section_groups.get_group(workflow)
-
-
-# Create new columns for purpose of filtering based on time
-# I wanted to be able to filter on time because some students found
-# the link to the project in Canvas before the instructor had demonstrated
-# what to do, and thus gave bad data. So, this would be a way to throw out
-# data that was recorded before a certain date and hour. For now though,
-# these lines are commented out, and all data is taken in.
-
-#workflow_data['day']=[int(i.split()[0].split('-')[-1]) for i in workflow_data['created_at']]
-#workflow_data['hour']=[int(i.split()[1].split(':')[0]) for i in workflow_data['created_at']]
-#workflow_data=workflow_data.loc[(workflow_data['day']>23) & (workflow_data['hour']>0)]
-
-
-# Group data by galaxy id
-gal_groups = workflow_data.groupby('galaxy_id')
-
-# for each galaxy, calculate the average central wavelength
-galaxy_names = [name for name, group in gal_groups]
-nclass = []
-lambdacen = []
-lambdaerr = []
-ra = []
-dec = []
-z = []
-
-for galname in galaxy_names:
-    lambdacen.append(gal_groups.get_group(galname)['lambdacen'].mean())
-    lambdaerr.append(gal_groups.get_group(galname)['lambdacen'].std())
-    ra.append(gal_groups.get_group(galname)['galaxy_metadata'].iloc[0]['ra'])
-    dec.append(gal_groups.get_group(galname)['galaxy_metadata'].iloc[0]['dec'])
-    z.append(gal_groups.get_group(galname)['galaxy_metadata'].iloc[0]['z'])
-    nclass.append(gal_groups.get_group(galname)['lambdacen'].count())
-
-# Approximate the distances based on the redshifts
-dist = [i * 3e5 / 68 for i in z]
-
-# create new dataframe with counts of classifications for each galaxy
-results = pd.DataFrame({'Galaxy ID' : galaxy_names,
-                   'RA' : ra,
-                   'Dec' : dec,
-                   'Dist' : dist,
-                   'N Class' : nclass,
-                   'lambda_av' : lambdacen,
-                   'lambda_err' : lambdaerr})
-results = results[['Galaxy ID', 'N Class', 'RA', 'Dec', 'Dist', 'lambda_av', 'lambda_err']]
-
-# export data frame as csv file
-results.to_csv(outfile, index=False)
+import pandas as pd
+import numpy as np
+from panoptes_io import json_loads
+from parquet_cache import load_classifications
+from reduction_state import ReductionState
+from instrumentation import Instrumentation, profiled
+
+
+'''
+1. Read in cvs
+2. get classification information
+3. get galaxy metadata (redshift, type)
+'''
+
+def get_classifications(annotations, metadata):
+    # Takes the annotations and metadata columns (i.e. every classification at once)
+    # and grabs the data relevant to the line identification.
+    # Returns a dataframe of float columns: xleft, width and nw
+    xleft=[]
+    width=[]
+    nw=[]
+    for annotation_json,metadata_json in zip(annotations,metadata):
+        marks=json_loads(annotation_json)[0]['value']
+        # Need the natural width in case students rescaled the window
+        nw.append(json_loads(metadata_json)['subject_dimensions'][0]['naturalWidth'])
+        if marks and len(marks[0])==7:# Error checks for a valid classification
+            xleft.append(marks[0]['x'])
+            width.append(marks[0]['width'])
+        else:
+            xleft.append(np.nan)
+            width.append(np.nan)
+    return pd.DataFrame({'xleft' : np.array(xleft, dtype=float),
+                         'width' : np.array(width, dtype=float),
+                         'nw'    : np.array(nw, dtype=float)},
+                        index=annotations.index)
+
+def _to_bool(value):
+    # Subject metadata sometimes stores flags as strings, and bool('False') is True
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
+
+def get_galaxy_metadata(subject_data):
+    # Takes the subject_data column, and returns a dataframe with each galaxy's
+    # ra, dec, z, galaxy_id (the DR7 objid) and whether it's elliptical
+    galaxies=[list(json_loads(subject_data_json).values())[0] for subject_data_json in subject_data]
+    galaxy_id=[galaxy['dr7objid'] for galaxy in galaxies]
+    try:
+        galaxy_id=np.array(galaxy_id, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):
+        galaxy_id=np.array(galaxy_id, dtype=object)
+    return pd.DataFrame({'ra'         : pd.to_numeric([galaxy['RA'] for galaxy in galaxies], errors='coerce'),
+                         'dec'        : pd.to_numeric([galaxy['Dec'] for galaxy in galaxies], errors='coerce'),
+                         'z'          : pd.to_numeric([galaxy['Redshift'] for galaxy in galaxies], errors='coerce'),
+                         'galaxy_id'  : galaxy_id,
+                         'elliptical' : np.array([_to_bool(galaxy['elliptical']) for galaxy in galaxies], dtype=bool)},
+                        index=subject_data.index)
+
+def calc_lambda_central(classifications):
+    # Input is a classification dictionary or dataframe with x_left, width, and natural
+    # window width. Works on single values or on whole columns at once.
+    xleft = classifications['xleft']
+    width = classifications['width']
+    nw = classifications['nw']
+    xmin = np.trunc((108./1152.)*nw)# These hardcoded pixel values represent the default window sizes
+    xmax = np.trunc((1081./1152.)*nw)# If the actual window was sized differently, the factor of 'nw' scales the result appropriately
+    lambdamin = 380.
+    lambdamax = 500.
+    lamperpix = (lambdamax - lambdamin) / (xmax - xmin)
+    lambdacen = (xleft + (width / 2.) - xmin) * lamperpix + lambdamin
+    return lambdacen
+
+# Columns of the raw export needed by parse_classifications, and the parsed columns
+# the reduction uses
+raw_columns = ['classification_id', 'annotations', 'metadata', 'subject_data']
+parsed_columns = ['classification_id', 'galaxy_id', 'ra', 'dec', 'z', 'lambdacen']
+
+def parse_classifications(chunk):
+    # Turns a chunk of raw classifications into flat numeric columns: each galaxy's
+    # metadata, the line mark, and the central wavelength marked
+    classifications = get_classifications(chunk['annotations'], chunk['metadata'])
+    parsed = get_galaxy_metadata(chunk['subject_data']).join(classifications)
+    parsed['lambdacen'] = calc_lambda_central(classifications)
+    parsed['classification_id'] = chunk['classification_id']
+    return parsed
+
+def get_galaxy_stats(workflow_data, hubble_const=68., robust=False, clip_sigma=None):
+    # Groups classifications by galaxy and computes every galaxy's stats in a single
+    # aggregation: the number of classifications, the average central wavelength and its
+    # scatter, its position, and its distance from the redshift, using hubble_const in km/s/Mpc.
+    # With robust set, the median and MAD (scaled to match a standard deviation) are used
+    # instead of the mean and standard deviation. With clip_sigma set, line marks more
+    # than clip_sigma (MAD-based) standard deviations from their galaxy's median are
+    # thrown out first, and the stats are computed from the marks that are left.
+    data = workflow_data[['galaxy_id', 'ra', 'dec', 'z', 'lambdacen']].copy()
+    if robust or clip_sigma is not None:
+        median = data.groupby('galaxy_id')['lambdacen'].transform('median')
+        data['absdev'] = (data['lambdacen'] - median).abs()
+        mad = 1.4826 * data.groupby('galaxy_id')['absdev'].transform('median')
+        if clip_sigma is not None:
+            bad = data['absdev'] > clip_sigma * mad
+            data.loc[bad, 'lambdacen'] = np.nan
+            # Measure the scatter of the marks that are left from their own median
+            median = data.groupby('galaxy_id')['lambdacen'].transform('median')
+            data['absdev'] = (data['lambdacen'] - median).abs()
+
+    agg = {'N Class' : ('lambdacen', 'count'),
+           'RA' : ('ra', 'first'),
+           'Dec' : ('dec', 'first'),
+           'z' : ('z', 'first')}
+    if robust:
+        agg['lambda_av'] = ('lambdacen', 'median')
+        agg['lambda_err'] = ('absdev', 'median')
+    else:
+        agg['lambda_av'] = ('lambdacen', 'mean')
+        agg['lambda_err'] = ('lambdacen', 'std')
+    results = data.groupby('galaxy_id').agg(**agg)
+    if robust:
+        results['lambda_err'] *= 1.4826
+
+    # Approximate the distances based on the redshifts
+    c = 3e5 # km/s
+    results['Dist'] = results['z'] * c / hubble_const
+    results = results.rename_axis('Galaxy ID').reset_index()
+    return results[['Galaxy ID', 'N Class', 'RA', 'Dec', 'Dist', 'lambda_av', 'lambda_err']]
+
+def get_partial_sums(workflow_data):
+    # Reduces classifications to running sums for each galaxy: the number of valid
+    # line marks, and the sum and sum of squares of their central wavelengths. Unlike
+    # means and standard deviations, these can be merged across runs.
+    data = workflow_data[['galaxy_id', 'ra', 'dec', 'z', 'lambdacen']].copy()
+    data['lambdasq'] = data['lambdacen']**2
+    return data.groupby('galaxy_id').agg(n=('lambdacen', 'count'),
+                                         lambda_sum=('lambdacen', 'sum'),
+                                         lambda_sumsq=('lambdasq', 'sum'),
+                                         ra=('ra', 'first'),
+                                         dec=('dec', 'first'),
+                                         z=('z', 'first'))
+
+def merge_partial_sums(partials):
+    # Merges a list of tables from get_partial_sums (None entries are skipped)
+    partials = [partial for partial in partials if partial is not None and len(partial)]
+    merged = pd.concat(partials).groupby(level=0).agg({'n' : 'sum',
+                                                       'lambda_sum' : 'sum',
+                                                       'lambda_sumsq' : 'sum',
+                                                       'ra' : 'first',
+                                                       'dec' : 'first',
+                                                       'z' : 'first'})
+    return merged.rename_axis('galaxy_id')
+
+def get_galaxy_stats_from_sums(sums, hubble_const=68.):
+    # Same output as get_galaxy_stats, computed from the running sums instead
+    n = sums['n']
+    lambda_av = sums['lambda_sum'] / n.where(n > 0)
+    lambda_var = (sums['lambda_sumsq'] - n * lambda_av**2) / (n - 1).where(n > 1)
+    c = 3e5 # km/s
+    results = pd.DataFrame({'Galaxy ID' : sums.index,
+                            'N Class' : n.values,
+                            'RA' : sums['ra'].values,
+                            'Dec' : sums['dec'].values,
+                            'Dist' : (sums['z'] * c / hubble_const).values,
+                            'lambda_av' : lambda_av.values,
+                            'lambda_err' : np.sqrt(lambda_var.clip(lower=0)).values})
+    return results[['Galaxy ID', 'N Class', 'RA', 'Dec', 'Dist', 'lambda_av', 'lambda_err']]
+
+# Raw input file exported from the project builder
+infile = "intro2astro-hubbles-law-classifications.csv"
+
+# Name of output csv file where results will be stored
+outfile='NU_astro_120.csv'
+
+# Name of workflow to be analyzed
+workflow='NU Highlights of Astronomy'
+
+# Hubble constant (km/s/Mpc) used to turn redshifts into distances
+hubble_const=68.
+
+# Set robust_stats to use the median/MAD of each galaxy's line marks instead of the
+# mean/standard deviation, and clip_sigma (e.g. 3.) to throw out badly placed marks
+robust_stats=False
+clip_sigma=None
+
+# In incremental mode, running per-galaxy sums are saved to state_dir, and each
+# rerun only parses classifications added to the export since the last run.
+# (Not compatible with robust_stats or clip_sigma, which need every line mark.)
+# Changing start_time or end_time makes the next run start over.
+incremental=False
+state_dir='reduction_state'
+
+# Where to cache the parsed export as Parquet, and how many processes to parse it
+# with (see parquet_cache.load_classifications). None for neither.
+parquet_cache_dir=None
+parse_workers=None
+
+# Filter classifications based on time
+# I wanted to be able to filter on time because some students found
+# the link to the project in Canvas before the instructor had demonstrated
+# what to do, and thus gave bad data. So, this would be a way to throw out
+# data that was recorded before a certain date and hour (UTC), e.g.
+# start_time='2016-10-24 01:00'. For now though, all data is taken in.
+start_time=None
+end_time=None
+
+# Instrumentation (see instrumentation.py), e.g. report_file='hubble_report.json',
+# profile_file='hubble.prof'
+report_file=None
+trace_memory=False
+profile_file=None
+
+def main(infile=infile, outfile=outfile, workflow=workflow, hubble_const=hubble_const,
+         robust_stats=robust_stats, clip_sigma=clip_sigma, incremental=incremental, state_dir=state_dir,
+         parquet_cache_dir=parquet_cache_dir, parse_workers=parse_workers, start_time=start_time,
+         end_time=end_time, report_file=report_file, trace_memory=trace_memory, profile_file=profile_file,
+         instrumentation=None):
+    # Runs the whole reduction with the settings above (any of which can be overridden),
+    # recording each stage in instrumentation (a new Instrumentation if not given).
+    # Returns the results dataframe.
+    instr = instrumentation or Instrumentation('hubble', trace_memory)
+    if incremental and (robust_stats or clip_sigma is not None):
+        raise ValueError('robust_stats and clip_sigma are not supported in incremental mode')
+    with profiled(profile_file):
+        # Read in only the classifications from the workflow we are concerned with, a chunk
+        # at a time, keeping just the parsed numeric columns
+        state = ReductionState(state_dir, 'hubble', workflow, infile,
+                               {'start_time' : start_time, 'end_time' : end_time}) if incremental else None
+        with instr.stage('load') as stage:
+            workflow_data = load_classifications(infile, workflow, parse_classifications, raw_columns, parsed_columns,
+                                                 start_time, end_time, state.last_id if state else None,
+                                                 parquet_cache_dir, parse_workers)
+            stage['rows'] = len(workflow_data)
+
+        if not incremental:
+            # For each galaxy, calculate the average central wavelength and distance
+            with instr.stage('aggregate') as stage:
+                results = get_galaxy_stats(workflow_data, hubble_const, robust_stats, clip_sigma)
+                stage['rows'] = len(results)
+        else:
+            with instr.stage('merge') as stage:
+                sums = merge_partial_sums([state.load_table(), get_partial_sums(workflow_data)])
+                state.save(sums, workflow_data['classification_id'])
+                stage['rows'] = len(sums)
+            with instr.stage('aggregate') as stage:
+                results = get_galaxy_stats_from_sums(sums, hubble_const)
+                stage['rows'] = len(results)
+
+        # export data frame as csv file
+        with instr.stage('write') as stage:
+            results.to_csv(outfile, index=False)
+            stage['rows'] = len(results)
+
+    if report_file:
+        instr.write(report_file)
+    return results
+
+if __name__=='__main__':
+    main()
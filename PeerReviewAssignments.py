@@ -1,37 +1,23 @@
-from itertools import groupby,chain
-import requests
-import random
-import copy
+import io
+import csv
+from peer_review_solver import assign_reviews
+from peer_review_stats import validate_assignments
+
+# One Canvas client per auth token, so every step of a run shares the same HTTP
+# session and the roster is only fetched once
+_canvas_clients={}
+
+def get_canvas_client(canvas_auth_token):
+    # canvas_client (and requests) are only imported when Canvas is actually used
+    if canvas_auth_token not in _canvas_clients:
+        from canvas_client import CanvasClient
+        _canvas_clients[canvas_auth_token]=CanvasClient(canvas_auth_token)
+    return _canvas_clients[canvas_auth_token]
 
 # Returns all raw student info from a given Canvas course.
 def _get_student_info(course_id, canvas_auth_token):
-    canvas_domain='https://canvas.northwestern.edu'
-    # Need to check number of students, since if >100 Canvas will paginate results,
-    # which necessitates generating multiple queries
-    max_per_page=100 # This seems to be the absolute max allowed, probably don't change this
-    url=[canvas_domain,
-         '/api/v1/courses/',
-         str(course_id),
-         '?include[]=total_students&access_token=',
-         canvas_auth_token
-        ]
-    c=requests.get(''.join(url)).json()
-    num_students=c['total_students']
-    pages=int(num_students/max_per_page)+1
-
-    # Grabs the pages of enrolled users from Canvas, returns all enrolled users
-    base_student_url=[canvas_domain,
-                      '/api/v1/courses/',
-                      str(course_id),
-                      '/enrollments',# Specifies course and desired data
-                      '?type=StudentEnrollment', # Only grab students, ignore TAs, teachers
-                      '&include[]=group_ids', # Also include group info - may be useful
-                      '&per_page='+str(max_per_page),
-                      '&access_token='+canvas_auth_token # parameters
-                      ]
-
-    student_pages=[requests.get(''.join(base_student_url)+'&page='+str(i)).json() for i in range(1,pages+1)]
-    return list(chain.from_iterable(student_pages))
+    # Canvas paginates results, so the client follows the pages it links to
+    return get_canvas_client(canvas_auth_token).get_students(course_id)
 
 
 
@@ -47,40 +33,58 @@ def load_students_from_canvas_course(course_id, canvas_auth_token):
 # Last name, First name, Group number
 def load_students_from_file(filename):
     stdnts=[]
-    with open(filename, 'r') as myfile:
+    with io.open(filename, 'r', encoding='utf-8') as myfile:
         for line in myfile:
+            if not line.strip():
+                continue
             dat=[x.strip() for x in line.strip('\n').split(',')]
             name=dat[0]+', '+dat[1]
-            stdnts.append((unicode(name, 'utf-8'),int(dat[2])))
+            stdnts.append((name,int(dat[2])))
     return stdnts
 
+# Saves the assignments to a csv file, one line per student:
+# Name, Group, then the groups whose videos they are to review
+def save_assignments(results, filename):
+    with io.open(filename, 'w', encoding='utf-8', newline='') as myfile:
+        writer=csv.writer(myfile)
+        for result in results:
+            writer.writerow([result[0], result[1]]+list(result[2]))
+
 
 
 # This function takes a "results" list that is output from the peer-review
 # assigning algorithm and emails the students their peer-review assignments.
-def email_students_in_canvas(results, course_id, canvas_auth_token):
-    canvas_domain='https://canvas.northwestern.edu'
+# With personalize=False the greeting leaves out the student's name, so every student
+# with the same videos to review gets the same message, and each of those is sent
+# as a single bulk message. With dry_run=True nothing is sent, but the messages are
+# built and counted as if they were. Returns the MessageStats of the send.
+def email_students_in_canvas(results, course_id, canvas_auth_token, personalize=True, dry_run=False):
+    client=get_canvas_client(canvas_auth_token)
     # Emailing students requires their user_id within Canvas, so we grab
     # student info so we can match names to ids
-    student_info=_get_student_info(course_id, canvas_auth_token)
+    user_ids=client.get_user_ids(course_id)
 
     # Construct the template email to be sent out
     email_subj='Peer Review Videos'
-    email_body=''.join(['Hi {0},\n\n',
+    email_body=''.join(['Hi {0},\n\n' if personalize else 'Hi,\n\n',
          'Please peer-review the videos from Groups {1} and {2}.\n\n',
          'Cheers,\n\n',
          '[YourNameHere]'])
 
+    messages=[]
+    missing=[]
     for result in results:
-        user_id=[s['user']['id'] for s in student_info if s['user']['sortable_name']==result[0]][0]
-        msg=''.join(email_body).format(result[0].split(',')[1].strip(), *result[2])
-        email_url=[canvas_domain,
-                  '/api/v1/conversations',
-                  '?recipients[]='+str(user_id),
-                  '&subject='+email_subj,
-                  '&body='+msg,
-                  '&access_token='+canvas_auth_token]
-        requests.post(''.join(email_url))
+        if result[0] not in user_ids:
+            missing.append(result[0])
+            continue
+        msg=email_body.format(result[0].split(',')[1].strip(), *result[2])
+        messages.append((user_ids[result[0]], email_subj, msg))
+
+    stats=client.send_messages(messages, dry_run=dry_run)
+    for name in missing:
+        stats.record_failure([name], 'not found in the Canvas course roster')
+    print(stats.summary())
+    return stats
 
 # Canvas authorization token - should be generated by user on Canvas and copy-pasted here
 canvas_auth_token=''
@@ -88,64 +92,63 @@ canvas_auth_token=''
 #Canvas course id number for this class
 course_id=0
 
+#Choose how you load student info: from the Canvas course (use_canvas=True), or
+#from filename (use_canvas=False)
+use_canvas=True
 filename='test_file.csv'
 
-#Choose how you load student info by commenting out either of these
-students=load_students_from_canvas_course(course_id, canvas_auth_token)
-#students=load_students_from_file(filename)
-
-
-students.sort(key=lambda x: x[0])# Sort student list by name
-group_ids=list(set([x[1] for x in students])) # Grabs set of all possible group ids
-num_groups=len(group_ids)
 reviews_per_student=2
 
-# Generate the entire pool of reviews at once, to guarantee each video is in the pool
-# a minimum number of times. Some groups will get one extra review, depending on
-# the ratio of total reviews to the number of groups.
-initial_pool=[group_ids[ip%num_groups] for ip in range(reviews_per_student*len(students))]
-
-# Initialize the results array, where each element has the format:
-# (name, group, [list of videos to review])
-initial_results=[(stdnt[0], stdnt[1], reviews_per_student*[None])for stdnt in students]
-
-success=False
-while success==False:
-    success=True
-    pool=copy.copy(initial_pool)
-    results=copy.copy(initial_results)
-    for result in results:
-        if success:
-            for i in range(reviews_per_student):
-                possible_choices=list(set([p for p in pool if (p!= result[1] and p not in result[2])]))
-                if len(possible_choices)==0:
-                    # We've encountered a state where a student can't be assigned enough reviews,
-                    # so we should start over.
-                    success=False
-                    break
-                else:
-                    choice=random.choice(possible_choices)
-                    pool.remove(choice)
-                    result[2][i]=choice
-        else:
-            break
-
-[a[2].sort() for a in results]
-# If a student was somehow assigned their own group, or assigned duplicate reviews,
-# that will be printed here
-for result in results:
-    if (result[1] in result[2]) or len(result[2]) != len(list(set(result[2]))):
-        print result
-all_vids=list(chain(*[b[2] for b in results]))
-counts=[all_vids.count(item) for item in set(all_vids)]
-final_counts=[(idx,counts.count(idx)) for idx in set(counts)]
-final_results=copy.deepcopy(results)
-
-
-
-
-# If you used Canvas to get student info, you can also use Canvas to send out emails informing the students which videos they are to peer-review. The command to do so is commented out below to avoid accidentally sending out a mass email.
-
-#Before running this command, please double-check the function's code (defined along with the other functions in the 2nd cell of this notebook), and verify that the Canvas domain is correct, and that the email subject and body are to your liking. Once you've done so, you can uncomment and run the function below.
-
-#email_students_in_canvas(final_results, course_id, canvas_auth_token)
+# Set to an integer to get the same assignments every time the script is run
+seed=None
+
+# Set to a csv file name to save the assignments to (see save_assignments)
+outfile=None
+
+# If you used Canvas to get student info, you can also use Canvas to send out emails
+# informing the students which videos they are to peer-review. This is off by default
+# to avoid accidentally sending out a mass email. Before turning it on, please
+# double-check the code of email_students_in_canvas above, and verify that the Canvas
+# domain is correct, and that the email subject and body are to your liking. Setting
+# dry_run first builds the emails without sending them.
+send_emails=False
+personalize_emails=True
+dry_run=False
+
+def main(course_id=course_id, canvas_auth_token=canvas_auth_token, use_canvas=use_canvas, filename=filename,
+         reviews_per_student=reviews_per_student, seed=seed, outfile=outfile, send_emails=send_emails,
+         personalize_emails=personalize_emails, dry_run=dry_run):
+    # Loads the students, assigns their reviews, checks the assignments and (optionally)
+    # saves them and emails them out, with the settings above (any of which can be
+    # overridden). Returns (results, report).
+    if use_canvas:
+        students=load_students_from_canvas_course(course_id, canvas_auth_token)
+    else:
+        students=load_students_from_file(filename)
+    students.sort(key=lambda x: x[0])# Sort student list by name
+
+    # Assign reviews so that every student gets reviews_per_student videos from groups other
+    # than their own, with no duplicates, and every video is reviewed the same number of times.
+    # Some groups will get one extra review, depending on the ratio of total reviews to the
+    # number of groups. Each element of results has the format:
+    # (name, group, [list of videos to review])
+    results=assign_reviews(students, reviews_per_student, seed)
+
+    # Check that no student was assigned their own group or duplicate reviews, and see how
+    # evenly the reviews are spread over the groups. report is a dict; report['load'] has
+    # the min/max/std number of reviews per group, report['reviews_per_group'] the counts.
+    report=validate_assignments(results, reviews_per_student)
+    if not report['valid']:
+        raise ValueError('Invalid peer-review assignments: '+repr(dict((key, report[key]) for key in
+                         ['balanced', 'unreviewed_groups', 'self_reviews', 'duplicate_reviews', 'wrong_review_count'])))
+    print('Assigned {0} reviews each to {1} students in {2} groups; each video is reviewed {3}-{4} times'.format(
+          reviews_per_student, report['num_students'], report['num_groups'], report['load']['min'], report['load']['max']))
+
+    if outfile:
+        save_assignments(results, outfile)
+    if send_emails:
+        email_students_in_canvas(results, course_id, canvas_auth_token, personalize_emails, dry_run)
+    return results, report
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import runpy
+import shutil
+import argparse
+import tempfile
+import subprocess
+from instrumentation import Instrumentation
+
+# Runs each reduction end to end on the synthetic exports written by
+# make_synthetic_exports.py, and reports classifications per second, peak memory (RSS)
+# and the time spent in each stage (as recorded by each script's main()). SDSS lookups
+# are answered by a LocalSDSS, so nothing goes over the network. Each reduction is run
+# in a fresh Python process, so its peak RSS is its own (not counting any --workers
+# parsing processes). Rows per second leave out the time spent importing pandas and
+# the scripts, which is about the same however big the export is.
+#   python make_synthetic_exports.py --rows 100000 --outdir synthetic
+#   python benchmark_reductions.py --dir synthetic --report bench.json
+# Pass --compare with an earlier report to see how the timings have changed, or
+# --baseline to compare against the scripts as they were before they were reworked
+# (baseline_rev, or another git revision), which are run from a temporary directory.
+# The old Galaxy Zoo export can't be part of the baseline, since it makes three live
+# SDSS queries per galaxy through astroquery.
+
+reductions=['hubble', 'gzoo', 'zoo-tools']
+
+# Git revision of the original scripts, and the ones that can be run as a baseline
+baseline_rev='4061ec1'
+baseline_scripts={'hubble' : 'HubbleLawDataReduction.py', 'zoo-tools' : 'intro_to_zoo_tools_data_reduction.py'}
+
+def load_rows(instr):
+    # Number of classifications the reduction loaded
+    return [stage['rows'] for stage in instr.stages if stage['stage']=='load'][0]
+
+def run_hubble(datadir, outdir, instr, workers=None, sdss_latency=0.):
+    with instr.stage('import'):
+        import HubbleLawDataReduction as hub
+    hub.main(infile=os.path.join(datadir, hub.infile), outfile=os.path.join(outdir, hub.outfile),
+             incremental=False, parse_workers=workers, instrumentation=instr)
+    return load_rows(instr)
+
+def run_gzoo(datadir, outdir, instr, workers=None, sdss_latency=0.):
+    with instr.stage('import'):
+        import GalaxyZooDataExport as gz
+        from make_synthetic_exports import load_local_sdss
+    gz.main(infile=os.path.join(datadir, gz.infile),
+            workflow_outfile=os.path.join(outdir, gz.workflow_outfile), zoo_outfile=os.path.join(outdir, gz.zoo_outfile),
+            sdss_cache_file=None, sdss_client=load_local_sdss(datadir, sdss_latency), incremental=False,
+            parse_workers=workers, instrumentation=instr)
+    return load_rows(instr)
+
+def run_zoo_tools(datadir, outdir, instr, workers=None, sdss_latency=0.):
+    with instr.stage('import'):
+        import intro_to_zoo_tools_data_reduction as zt
+    zt.main(infile=os.path.join(datadir, zt.infile), outfile=os.path.join(outdir, zt.outfile),
+            incremental=False, parse_workers=workers, instrumentation=instr)
+    return load_rows(instr)
+
+runners={'hubble' : run_hubble, 'gzoo' : run_gzoo, 'zoo-tools' : run_zoo_tools}
+
+def _finish_report(instr, rows):
+    # Adds the throughput to instr's report, and flattens its stages to {stage : seconds}
+    report=instr.report()
+    report['rows']=rows
+    report['run_seconds']=sum(stage['seconds'] for stage in report['stages'] if stage['stage']!='import')
+    report['rows_per_second']=rows/report['run_seconds'] if rows and report['run_seconds']>0 else None
+    report['stages']=dict((stage['stage'], stage['seconds']) for stage in report['stages'])
+    return report
+
+def run_one(name, datadir, workers=None, sdss_latency=0.):
+    # Runs one reduction in this process, and returns its report as a dict
+    outdir=tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        instr=Instrumentation(name)
+        rows=runners[name](datadir, outdir, instr, workers, sdss_latency)
+    finally:
+        shutil.rmtree(outdir)
+    return _finish_report(instr, rows)
+
+def run_baseline_script(name, script, rows=None):
+    # Runs one of the original scripts in this process, from the directory it's in
+    # (which holds the export it reads), and returns its report as a dict. The old
+    # scripts aren't split into stages, so everything after the imports is one 'run'
+    # stage. rows is the number of classifications the current script loaded.
+    instr=Instrumentation(name)
+    os.chdir(os.path.dirname(script))
+    with instr.stage('import'):
+        import numpy
+        import pandas
+    with instr.stage('run'):
+        runpy.run_path(script, run_name='__main__')
+    return _finish_report(instr, rows)
+
+def run_in_subprocess(name, datadir, workers=None, sdss_latency=0.):
+    command=[sys.executable, os.path.abspath(__file__), '--run-one', name, '--dir', datadir,
+             '--sdss-latency', str(sdss_latency)]
+    if workers:
+        command+=['--workers', str(workers)]
+    output=subprocess.check_output(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def run_baseline(name, datadir, rev=baseline_rev, rows=None):
+    # Runs the original version of a reduction's script (from git revision rev) in a
+    # fresh Python process, on a copy of the export in a temporary directory. Returns
+    # its report, or None if there's no runnable original of this reduction.
+    if name not in baseline_scripts:
+        return None
+    from make_synthetic_exports import hubble_file, zoo_tools_file
+    export_file={'hubble' : hubble_file, 'zoo-tools' : zoo_tools_file}[name]
+    repo=os.path.dirname(os.path.abspath(__file__))
+    source=subprocess.check_output(['git', 'show', rev+':'+baseline_scripts[name]], cwd=repo)
+    tmpdir=tempfile.mkdtemp(prefix='baseline_')
+    try:
+        script=os.path.join(tmpdir, baseline_scripts[name])
+        with open(script, 'wb') as f:
+            f.write(source)
+        shutil.copy(os.path.join(datadir, export_file), tmpdir)
+        command=[sys.executable, os.path.abspath(__file__), '--run-baseline', name, '--script', script]
+        if rows is not None:
+            command+=['--rows', str(rows)]
+        output=subprocess.check_output(command, cwd=repo)
+    finally:
+        shutil.rmtree(tmpdir)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def print_reports(reports, baseline=None):
+    baseline=dict((report['reduction'], report) for report in (baseline or []))
+    print('{0:>10} {1:>9} {2:>9} {3:>11} {4:>9}  {5}'.format('reduction', 'rows', 'total (s)', 'rows/s', 'peak MB', 'stages (s)'))
+    for report in reports:
+        stages=', '.join('{0} {1:.3f}'.format(stage, seconds) for stage,seconds in report['stages'].items())
+        print('{0:>10} {1:>9} {2:>9.3f} {3:>11.0f} {4:>9.1f}  {5}'.format(
+              report['reduction'], report['rows'], report['seconds'], report['rows_per_second'] or 0.,
+              report['peak_rss_mb'] or float('nan'), stages))
+        old=baseline.get(report['reduction'])
+        if old is not None:
+            # Speedup of everything but the imports (reports from before run_seconds
+            # was recorded only have the total)
+            speedup=old.get('run_seconds', old['seconds'])/report.get('run_seconds', report['seconds'])
+            print('{0:>10} {1:>9} {2:>8.2f}x {3:>11} {4:>8.2f}x  (vs. baseline)'.format(
+                  '', '', speedup, '', report['peak_rss_mb']/old['peak_rss_mb']
+                  if report['peak_rss_mb'] and old['peak_rss_mb'] else float('nan')))
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Benchmark the reductions on synthetic exports')
+    parser.add_argument('--dir', default='synthetic', help='directory written by make_synthetic_exports.py')
+    parser.add_argument('--reductions', nargs='+', choices=reductions, default=reductions)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes to parse the exports with')
+    parser.add_argument('--sdss-latency', type=float, default=0., help='simulated seconds per SDSS query')
+    parser.add_argument('--report', help='file to write the JSON report to')
+    compare=parser.add_mutually_exclusive_group()
+    compare.add_argument('--compare', help='earlier JSON report to compare against')
+    compare.add_argument('--baseline', nargs='?', const=baseline_rev, metavar='REV',
+                         help='also run the original scripts (from git revision REV, by default {0}) '
+                              'and compare against them'.format(baseline_rev))
+    parser.add_argument('--run-one', choices=reductions, help=argparse.SUPPRESS)
+    parser.add_argument('--run-baseline', choices=reductions, help=argparse.SUPPRESS)
+    parser.add_argument('--script', help=argparse.SUPPRESS)
+    parser.add_argument('--rows', type=int, help=argparse.SUPPRESS)
+    args=parser.parse_args()
+    datadir=os.path.abspath(args.dir)
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, datadir, args.workers, args.sdss_latency)))
+        sys.exit(0)
+    if args.run_baseline:
+        print(json.dumps(run_baseline_script(args.run_baseline, args.script, args.rows)))
+        sys.exit(0)
+
+    reports=[run_in_subprocess(name, datadir, args.workers, args.sdss_latency) for name in args.reductions]
+    baseline=None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline=json.load(f)
+    elif args.baseline:
+        baseline=[run_baseline(report['reduction'], datadir, args.baseline, report['rows']) for report in reports]
+        baseline=[report for report in baseline if report is not None]
+        print('Baseline (original scripts at {0}):'.format(args.baseline))
+        print_reports(baseline)
+        print('Current:')
+    print_reports(reports, baseline)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(reports, f, indent=2)
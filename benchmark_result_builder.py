@@ -0,0 +1,55 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from result_builder import ResultBuilder
+
+# Compares how long it takes to build a results table one row at a time, the old way
+# (pd.concat with a one-row dataframe per row) and with ResultBuilder, for a range of
+# table sizes. The rows look like the Galaxy Zoo export's output. pd.concat takes
+# quadratic time, so by default it's only timed up to 10000 rows, and the larger
+# tables are built with ResultBuilder alone. Raise --max-concat to time it anyway.
+#   python benchmark_result_builder.py --sizes 1000 10000 100000
+
+columns=['Galaxy ID', 'N_Votes', 'p_ell', 'p_sp', 'p_mrg', 'p_oth', 'g_mag', 'r_mag', 'z']
+
+def make_rows(n, seed=0):
+    rng=np.random.RandomState(seed)
+    values=rng.uniform(size=(n, len(columns)-2))
+    return [dict([('Galaxy ID', str(1237648720693755000+i)), ('N_Votes', int(rng.randint(1, 40)))]+
+                 list(zip(columns[2:], values[i]))) for i in range(n)]
+
+def build_with_concat(rows):
+    results=pd.DataFrame(dict((col,[]) for col in columns))
+    for row in rows:
+        results=pd.concat([results, pd.DataFrame(dict((col,[row[col]]) for col in columns))])
+    return results.reset_index(drop=True)
+
+def build_with_builder(rows):
+    results=ResultBuilder(columns)
+    for row in rows:
+        results.append(row)
+    return results.to_frame()
+
+def time_it(func, rows):
+    start=time.time()
+    func(rows)
+    return time.time()-start
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Benchmark building result tables row by row')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of rows (subjects) to build tables of')
+    parser.add_argument('--max-concat', type=int, default=10000,
+                        help='skip the pd.concat method above this many rows, since it scales quadratically')
+    args=parser.parse_args()
+
+    print('{0:>8} {1:>12} {2:>12} {3:>9}'.format('rows', 'concat (s)', 'builder (s)', 'speedup'))
+    for n in args.sizes:
+        rows=make_rows(n)
+        builder_time=time_it(build_with_builder, rows)
+        if n<=args.max_concat:
+            concat_time=time_it(build_with_concat, rows)
+            print('{0:>8} {1:>12.3f} {2:>12.3f} {3:>8.0f}x'.format(n, concat_time, builder_time, concat_time/builder_time))
+        else:
+            print('{0:>8} {1:>12} {2:>12.3f} {3:>9}'.format(n, 'skipped', builder_time, '-'))
@@ -0,0 +1,295 @@
+import json
+import time
+import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+canvas_domain='https://canvas.northwestern.edu'
+
+# Responses that mean Canvas is throttling us or is briefly unavailable, so a GET is
+# worth retrying. 500 is left out, since it usually means the request itself is bad.
+retry_statuses=(429, 502, 503, 504)
+
+# A POST (e.g. sending a conversation) may have gone through even if we never got the
+# response, e.g. after a 502/504 or a dropped connection, and retrying it could email
+# every recipient twice. So a POST is only retried when Canvas refused it outright:
+# when it throttled us (429, or 403 Rate Limit Exceeded), when it's down for
+# maintenance (503 with a Retry-After), or when we couldn't connect at all.
+
+# Talks to the Canvas REST API over a single pooled HTTP session, so every request in
+# a run reuses the same connections. Paginated results are fetched by following the
+# Link headers Canvas sends back; when the last page number is known, the remaining
+# pages are fetched concurrently on up to max_workers threads. Course rosters are
+# cached, so later steps of a run (e.g. emailing students) don't fetch them again.
+# Requests that Canvas throttles (or GETs that hit a gateway error, a dropped
+# connection or a timeout) are retried up to
+# max_retries times, waiting as long as the Retry-After header asks, or with
+# exponential backoff otherwise. Every request times out after timeout seconds,
+# given as (time to connect, time to wait for a response), so a hung connection
+# can't stall a run.
+class CanvasClient(object):
+    max_per_page=100 # This seems to be the absolute max allowed, probably don't change this
+    max_recipients=100 # Canvas won't take more recipients than this in one conversation
+
+    def __init__(self, canvas_auth_token, domain=canvas_domain, max_workers=8, session=None,
+                 max_retries=5, backoff=1., timeout=(10., 60.)):
+        self.domain=domain
+        self.max_workers=max_workers
+        self.max_retries=max_retries
+        self.backoff=backoff
+        self.timeout=timeout
+        if session is None:
+            session=requests.Session()
+            adapter=HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session=session
+        self.session.headers.update({'Authorization' : 'Bearer '+canvas_auth_token})
+        self._rosters={}
+        self._user_ids={}
+
+    def _url(self, path):
+        return path if path.startswith('http') else self.domain+path
+
+    def _request(self, method, path, **kwargs):
+        url=self._url(path)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries+1):
+            wait=self.backoff*2**attempt*(1.+random.random())
+            try:
+                response=getattr(self.session, method)(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt==self.max_retries or (method!='get' and not _never_connected(e)):
+                    raise
+                time.sleep(wait)
+                continue
+            if not _should_retry(response, method) or attempt==self.max_retries:
+                break
+            time.sleep(_retry_after(response, wait))
+        response.raise_for_status()
+        return response
+
+    def get(self, path, params=None):
+        return self._request('get', path, params=params)
+
+    def get_all_pages(self, path, params=None):
+        # Returns the combined list of results from every page of a paginated request
+        params=dict(params or {})
+        params['per_page']=self.max_per_page
+        first=self.get(path, params)
+        results=list(first.json())
+
+        last_page=_page_number(first.links.get('last'))
+        if last_page is not None:
+            def get_page(page):
+                return self.get(path, dict(params, page=page)).json()
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                for page in pool.map(get_page, range(2, last_page+1)):
+                    results.extend(page)
+        else:
+            # Canvas doesn't always say how many pages there are, so just keep following 'next'
+            response=first
+            while 'next' in response.links:
+                response=self.get(response.links['next']['url'])
+                results.extend(response.json())
+        return results
+
+    def get_students(self, course_id):
+        # Returns all raw student info (enrollments, including group ids) for a course
+        if course_id not in self._rosters:
+            self._rosters[course_id]=self.get_all_pages('/api/v1/courses/{0}/enrollments'.format(course_id),
+                                                        {'type' : 'StudentEnrollment', # Only grab students, ignore TAs, teachers
+                                                         'include[]' : 'group_ids'}) # Also include group info
+        return self._rosters[course_id]
+
+    def get_user_ids(self, course_id):
+        # Returns a dict of each student's sortable name (e.g. 'Last, First') to their
+        # Canvas user id, built once per course
+        if course_id not in self._user_ids:
+            self._user_ids[course_id]=dict((s['user']['sortable_name'], s['user']['id'])
+                                           for s in self.get_students(course_id))
+        return self._user_ids[course_id]
+
+    def post(self, path, data=None):
+        return self._request('post', path, data=data)
+
+    def send_messages(self, messages, dry_run=False):
+        # Sends Canvas conversations (messages that show up in the students' inboxes and
+        # are emailed to them). messages is a list of (user id, subject, body). Messages
+        # with the same subject and body are sent together as one bulk conversation, in
+        # which each recipient gets their own private copy. Conversations are sent on up
+        # to max_workers threads. With dry_run, nothing is actually sent.
+        # Returns a MessageStats.
+        batches=OrderedDict()
+        for user_id,subject,body in messages:
+            batches.setdefault((subject, body), []).append(user_id)
+        conversations=[]
+        for (subject,body),user_ids in batches.items():
+            for i in range(0, len(user_ids), self.max_recipients):
+                conversations.append((user_ids[i:i+self.max_recipients], subject, body))
+
+        def send(conversation):
+            user_ids,subject,body=conversation
+            data=[('recipients[]', str(user_id)) for user_id in user_ids]+[('subject', subject), ('body', body)]
+            if len(user_ids)>1:
+                data+=[('group_conversation', 'true'), ('bulk_message', 'true')]
+            if not dry_run:
+                self.post('/api/v1/conversations', data)
+
+        stats=MessageStats(dry_run)
+        start=time.time()
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures=[pool.submit(send, conversation) for conversation in conversations]
+            for conversation,future in zip(conversations, futures):
+                try:
+                    future.result()
+                    stats.record(conversation[0])
+                except requests.RequestException as e:
+                    stats.record_failure(conversation[0], e)
+        stats.seconds=time.time()-start
+        return stats
+
+class MessageStats(object):
+    def __init__(self, dry_run=False):
+        self.dry_run=dry_run
+        self.conversations=0
+        self.recipients=0
+        self.failures=[] # (recipients, reason) for each message that couldn't be sent
+        self.seconds=0.
+
+    def record(self, recipients):
+        self.conversations+=1
+        self.recipients+=len(recipients)
+
+    def record_failure(self, recipients, reason):
+        self.failures.append((recipients, reason))
+
+    def summary(self):
+        # Returns a short, printable report of how many messages were sent, how fast, and what failed
+        lines=['Canvas messages{0}: {1} recipients in {2} conversations, {3:.2f}s ({4:.1f} recipients/s), {5} failed'.format(
+                ' (dry run, not sent)' if self.dry_run else '', self.recipients, self.conversations,
+                self.seconds, self.recipients/self.seconds if self.seconds>0 else 0., len(self.failures))]
+        for recipients,reason in self.failures:
+            lines.append('  failed: {0}: {1}'.format(recipients, reason))
+        return '\n'.join(lines)
+
+def _should_retry(response, method='get'):
+    # Canvas reports being throttled with 403 Forbidden (Rate Limit Exceeded) as well as 429
+    if response.status_code==403:
+        return 'Rate Limit Exceeded' in response.text
+    if method!='get':
+        return response.status_code==429 or (response.status_code==503 and 'Retry-After' in response.headers)
+    return response.status_code in retry_statuses
+
+def _never_connected(error):
+    # Whether a ConnectionError happened before a connection was made, so none of the
+    # request reached Canvas
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason=getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def _retry_after(response, default):
+    # How long the server asked us to wait before retrying, in seconds
+    value=response.headers.get('Retry-After')
+    try:
+        return max(0., float(value))
+    except (TypeError, ValueError):
+        return default
+
+def _page_number(link):
+    # Gets the page number from a Link header entry, if it's numeric
+    if link is None:
+        return None
+    page=parse_qs(urlparse(link['url']).query).get('page', [None])[0]
+    if page is None or not page.isdigit():
+        return None
+    return int(page)
+
+
+# Local stand-in for a Canvas server, to use as the session of a CanvasClient so it can
+# be run offline. Serves a course roster with the same pagination and Link headers as
+# Canvas, and records every conversation posted instead of sending it. get_errors and
+# post_errors are lists of status codes to answer the first GETs and POSTs with (e.g.
+# [429, 503]), to check that throttled requests are retried. An entry can also be an
+# exception (e.g. a requests.ConnectionError) to raise instead of answering.
+class FakeCanvasSession(object):
+    def __init__(self, students, course_id=0, domain=canvas_domain, send_last_link=True, get_errors=(),
+                 post_errors=()):
+        # students is a list of enrollment dicts, as Canvas returns them
+        self.students=students
+        self.course_id=course_id
+        self.domain=domain
+        self.send_last_link=send_last_link
+        self.get_errors=list(get_errors)
+        self.post_errors=list(post_errors)
+        self.headers={}
+        self.requests=[] # (method, url, params or data, timeout) of every request made
+        self.conversations=[]
+        self.lock=threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        with self.lock:
+            self.requests.append(('GET', url, params, timeout))
+            if self.get_errors:
+                return _error_response(self.get_errors.pop(0))
+        query=parse_qs(urlparse(url).query)
+        params=dict(params or {})
+        for key in query:
+            params.setdefault(key, query[key][0])
+        path=urlparse(url).path
+        if path!='/api/v1/courses/{0}/enrollments'.format(self.course_id):
+            return FakeResponse(404, {'errors' : [{'message' : 'not found'}]})
+
+        per_page=int(params.get('per_page', 10))
+        page=int(params.get('page', 1))
+        num_pages=max(1, (len(self.students)+per_page-1)//per_page)
+        base=self.domain+path+'?type=StudentEnrollment&include[]=group_ids&per_page={0}&page='.format(per_page)
+        links={'current' : {'url' : base+str(page)},
+               'first' : {'url' : base+'1'}}
+        if page<num_pages:
+            links['next']={'url' : base+str(page+1)}
+        if self.send_last_link:
+            links['last']={'url' : base+str(num_pages)}
+        return FakeResponse(200, self.students[(page-1)*per_page:page*per_page], links=links)
+
+    def post(self, url, data=None, timeout=None):
+        with self.lock:
+            self.requests.append(('POST', url, data, timeout))
+            if self.post_errors:
+                return _error_response(self.post_errors.pop(0))
+            self.conversations.append(data)
+        return FakeResponse(201, [{'id' : len(self.conversations)}])
+
+    def mount(self, prefix, adapter):
+        pass
+
+def _error_response(error):
+    # Answers a request with an error status code, or raises an exception
+    if isinstance(error, Exception):
+        raise error
+    return FakeResponse(error, {'errors' : [{'message' : 'Rate Limit Exceeded'}]}, headers={'Retry-After' : '0'})
+
+class FakeResponse(object):
+    def __init__(self, status_code, body, links=None, headers=None):
+        self.status_code=status_code
+        self.body=body
+        self.links=links or {}
+        self.headers=headers or {}
+        self.text=json.dumps(body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code>=400:
+            raise requests.HTTPError('{0} error from fake Canvas server'.format(self.status_code), response=self)
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+# Records where a reduction spends its time and memory. Each stage of a run (loading
+# the export, aggregating, querying SDSS, writing results...) is wrapped in
+#   with instr.stage('load') as stage:
+#       ...
+#       stage['rows']=len(data)
+# which records its wall time, row count (if set), and the change in resident memory
+# (RSS). With trace_memory, tracemalloc also tracks the peak Python memory allocated
+# during each stage, which is more precise but makes the run noticeably slower.
+# instr.report() gives everything as a dict, and instr.write(path) saves it as JSON.
+# Each reduction script's main() is instrumented this way: set its report_file to save
+# the report, trace_memory to turn on tracemalloc, and profile_file to also profile
+# the whole run with cProfile (see profiled below).
+
+# Lower edges (in seconds) of the bins of the SDSS query latency histograms. The last
+# bin holds everything slower.
+latency_bins=[0., 0.1, 0.25, 0.5, 1., 2., 5., 10.]
+
+def current_rss_mb():
+    # Resident memory of this process right now, in MB (None where unavailable)
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2.**20
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss/2.**20
+
+def peak_rss_mb():
+    # Peak resident memory of this process so far, in MB (None where unavailable)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak/(2.**20 if sys.platform=='darwin' else 2.**10)
+
+def latency_histogram(stats, bins=latency_bins):
+    # Summarizes the per-query latencies in an sdss_queries.QueryStats, for each kind
+    # of query: the count, median, 95th percentile and max, and a histogram keyed by
+    # each bin's lower edge
+    report={}
+    for kind in sorted(set(kind for kind,_,_ in stats.latencies)):
+        seconds=np.array([t for k,_,t in stats.latencies if k==kind])
+        counts=np.histogram(seconds, bins=list(bins)+[np.inf])[0]
+        report[kind]={'queries' : len(seconds),
+                      'ids' : sum(n for k,n,_ in stats.latencies if k==kind),
+                      'median' : float(np.median(seconds)),
+                      'p95' : float(np.percentile(seconds, 95)),
+                      'max' : float(seconds.max()),
+                      'histogram' : dict(('{0:g}s'.format(edge), int(count)) for edge,count in zip(bins, counts))}
+    return {'latency' : report,
+            'retries' : stats.retries,
+            'failed_ids' : dict((kind, len(ids)) for kind,ids in stats.failed_ids.items())}
+
+class Instrumentation(object):
+    def __init__(self, name, trace_memory=False):
+        self.name=name
+        self.trace_memory=trace_memory
+        self.stages=[]
+        self.sdss=None
+        self.started=time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._start=time.time()
+
+    @contextmanager
+    def stage(self, name):
+        record={'stage' : name}
+        started_tracing=False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing=True
+            tracemalloc.reset_peak()
+            traced_before=tracemalloc.get_traced_memory()[0]
+        rss_before=current_rss_mb()
+        start=time.time()
+        try:
+            yield record
+        finally:
+            record['seconds']=time.time()-start
+            rss=current_rss_mb()
+            if rss is not None:
+                record['rss_mb']=rss
+                record['rss_delta_mb']=rss-rss_before
+            if self.trace_memory:
+                record['traced_peak_mb']=(tracemalloc.get_traced_memory()[1]-traced_before)/2.**20
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+
+    def add_sdss_stats(self, stats):
+        # Adds latency histograms for the queries recorded in an sdss_queries.QueryStats
+        self.sdss=latency_histogram(stats)
+
+    def report(self):
+        report={'reduction' : self.name,
+                'started' : self.started,
+                'seconds' : time.time()-self._start,
+                'peak_rss_mb' : peak_rss_mb(),
+                'stages' : self.stages}
+        if self.sdss is not None:
+            report['sdss']=self.sdss
+        return report
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+@contextmanager
+def profiled(profile_file=None):
+    # Runs the body under cProfile and saves the stats to profile_file, which can be
+    # read with pstats or snakeviz. Does nothing if profile_file isn't set.
+    if not profile_file:
+        yield
+        return
+    profiler=cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
@@ -0,0 +1,115 @@
+import os
+import sys
+import argparse
+import importlib
+
+# Command line entry point for the data reductions and the peer-review assignments:
+#   python intro2astro.py hubble --infile intro2astro-hubbles-law-classifications.csv
+#   python intro2astro.py gzoo --infile galaxy-zoo-in-astronomy-101-classifications.csv --workflow 'NU Highlights of Astronomy'
+#   python intro2astro.py zoo-tools --infile introduction-to-the-zoo-tools-classifications.csv --with-distance
+#   python intro2astro.py peer-review --students groups.csv --seed 1 --outfile assignments.csv
+# Each subcommand runs the main() of its script. Anything not given on the command
+# line keeps the setting at the top of that script. Scripts (and with them pandas,
+# numpy, astroquery and requests) are only imported once a subcommand runs, so
+# --help and bad arguments don't wait on them.
+
+# Subcommand -> module whose main() it runs
+commands={'hubble'      : 'HubbleLawDataReduction',
+          'gzoo'        : 'GalaxyZooDataExport',
+          'zoo-tools'   : 'intro_to_zoo_tools_data_reduction',
+          'peer-review' : 'PeerReviewAssignments'}
+
+def _flag(parser, name, help):
+    # An on/off option that's left out of the settings (so the script's own setting is
+    # kept) unless given
+    dest=name.replace('-', '_')
+    group=parser.add_mutually_exclusive_group()
+    group.add_argument('--'+name, dest=dest, action='store_true', default=None, help=help)
+    group.add_argument('--no-'+name, dest=dest, action='store_false', default=None, help=argparse.SUPPRESS)
+
+def _add_reduction_options(parser, workflow_dest):
+    parser.add_argument('--infile', help='classification export from the project builder')
+    parser.add_argument('--workflow', dest=workflow_dest, help='name of the workflow to reduce')
+    _flag(parser, 'incremental', 'only parse classifications added since the last run, keeping running results in --state-dir')
+    parser.add_argument('--state-dir', help='directory for the incremental mode state')
+    parser.add_argument('--parquet-cache-dir', help='keep the parsed classifications here as Parquet (needs pyarrow)')
+    parser.add_argument('--parse-workers', type=int, help='number of processes to parse the export with')
+    parser.add_argument('--report', dest='report_file', help='write a JSON report of each stage\'s time and memory here')
+    _flag(parser, 'trace-memory', 'also track memory allocations per stage with tracemalloc (slower)')
+    parser.add_argument('--profile', dest='profile_file', help='profile the run with cProfile, saving the stats here')
+
+def make_parser():
+    parser=argparse.ArgumentParser(prog='intro2astro',
+                                   description='Reduce Zooniverse classification exports and assign peer reviews. '
+                                               'Options that are left out keep the settings at the top of each script.')
+    subparsers=parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required=True
+
+    hubble=subparsers.add_parser('hubble', help='galaxy distances and line wavelengths for the Hubble\'s law lab')
+    _add_reduction_options(hubble, 'workflow')
+    hubble.add_argument('--outfile', help='csv file to write the results to')
+    hubble.add_argument('--hubble-const', type=float, help='Hubble constant (km/s/Mpc) used to turn redshifts into distances')
+    _flag(hubble, 'robust-stats', 'use the median/MAD of each galaxy\'s line marks instead of the mean/standard deviation')
+    hubble.add_argument('--clip-sigma', type=float, help='throw out line marks more than this many sigma from their galaxy\'s median')
+    hubble.add_argument('--start', dest='start_time', help='only use classifications made at or after this time (UTC)')
+    hubble.add_argument('--end', dest='end_time', help='only use classifications made before this time (UTC)')
+
+    gzoo=subparsers.add_parser('gzoo', help='Galaxy Zoo vote fractions, compared with SDSS and the original Galaxy Zoo')
+    _add_reduction_options(gzoo, 'workflow_name')
+    gzoo.add_argument('--workflow-outfile', help='csv file to write our classification results to')
+    gzoo.add_argument('--zoo-outfile', help='csv file to write the original Galaxy Zoo results to')
+    gzoo.add_argument('--sdss-cache', dest='sdss_cache_file', help='SQLite cache of SDSS lookups (\'none\' to not cache)')
+    _flag(gzoo, 'refresh-sdss-cache', 're-query SDSS for every galaxy')
+    gzoo.add_argument('--sdss-cache-max-age', dest='sdss_cache_max_age_days', type=float,
+                      help='re-query and evict cached SDSS lookups older than this many days')
+    gzoo.add_argument('--sdss-cache-max-entries', type=int,
+                      help='evict the oldest cached SDSS lookups once the cache holds more than this many')
+    gzoo.add_argument('--sdss-workers', dest='sdss_max_workers', type=int, help='number of SDSS queries to run at once')
+    gzoo.add_argument('--sdss-rate', dest='sdss_query_rate', type=float, help='average SDSS queries per second allowed')
+    gzoo.add_argument('--sdss-retries', dest='sdss_max_retries', type=int, help='times to retry a failed SDSS query')
+    gzoo.add_argument('--sdss-chunk-size', type=int, help='number of galaxies to look up in each SDSS query')
+    _flag(gzoo, 'allow-sdss-failures', 'write the results even if some SDSS lookups failed, leaving those galaxies blank')
+
+    zoo_tools=subparsers.add_parser('zoo-tools', help='home and institution coordinates from the zoo tools tutorial')
+    _add_reduction_options(zoo_tools, 'workflow')
+    zoo_tools.add_argument('--outfile', help='csv file to write the results to')
+    _flag(zoo_tools, 'with-distance', 'also output the distance between each home and institution')
+
+    peer_review=subparsers.add_parser('peer-review', help='assign video peer reviews to students in groups')
+    source=peer_review.add_mutually_exclusive_group()
+    source.add_argument('--students', dest='filename',
+                        help='csv file of students, one "Last name, First name, Group number" per line')
+    source.add_argument('--course-id', type=int, help='Canvas course to load the students and their groups from')
+    peer_review.add_argument('--token', dest='canvas_auth_token',
+                             help='Canvas authorization token (default: $CANVAS_AUTH_TOKEN, or the script\'s setting)')
+    peer_review.add_argument('--reviews-per-student', type=int)
+    peer_review.add_argument('--seed', type=int, help='seed, to get the same assignments every time')
+    peer_review.add_argument('--outfile', help='csv file to save the assignments to')
+    _flag(peer_review, 'send-emails', 'email each student their assignments through Canvas')
+    _flag(peer_review, 'personalize-emails', 'greet each student by name (use --no-personalize-emails to send identical emails in bulk)')
+    _flag(peer_review, 'dry-run', 'build the emails without sending them')
+    return parser
+
+def get_settings(args):
+    # Turns the parsed arguments into keyword arguments for the subcommand's main(),
+    # leaving out anything that wasn't given
+    settings=dict((key, value) for key,value in vars(args).items() if key!='command' and value is not None)
+    if args.command=='gzoo' and str(settings.get('sdss_cache_file', '')).lower()=='none':
+        settings['sdss_cache_file']=None
+    if args.command=='peer-review':
+        if 'filename' in settings:
+            settings['use_canvas']=False
+        elif 'course_id' in settings:
+            settings['use_canvas']=True
+        if 'canvas_auth_token' not in settings and os.environ.get('CANVAS_AUTH_TOKEN'):
+            settings['canvas_auth_token']=os.environ['CANVAS_AUTH_TOKEN']
+    return settings
+
+def main(argv=None):
+    args=make_parser().parse_args(argv)
+    module=importlib.import_module(commands[args.command])
+    module.main(**get_settings(args))
+
+if __name__=='__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -1,72 +1,143 @@
+import numpy as np
 import pandas as pd
+from panoptes_io import json_loads
+from parquet_cache import load_classifications
+from reduction_state import ReductionState
+from instrumentation import Instrumentation, profiled
 
-# Check if a value can be mapped to a float
-def check_input(value):
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
+# Columns of the raw export needed by parse_tasks, and the parsed columns the reduction uses
+raw_columns=['classification_id','annotations']
+value_columns=['home_lat','home_lon','inst_lat','inst_lon']
+label_columns=['home_lat_ns','home_lon_ew','inst_lat_ns','inst_lon_ew']
+parsed_columns=['classification_id']+value_columns+label_columns
+
+def _as_text(value):
+    # Numerical answers are usually strings, but keep them all as strings (or None)
+    # so each column has a single type
+    if value is None:
+        return None
+    return value if isinstance(value,str) else str(value)
+
+def parse_tasks(chunk):
+    # Turns a chunk of raw classifications into one row per classification, with the
+    # four numerical answers (as text, since they still need checking) and their NSEW labels
+    rows=[]
+    for annotations in chunk['annotations']:
+        tasks=json_loads(annotations)[0]['value']
+
+        # Since tasks alternate numerical values / NSEW options,
+        # even indices give numerical values, odd indices give NSEW choices
+        rows.append([_as_text(tasks[i]['value']) for i in (0,2,4,6)]+
+                    [tasks[i]['value'][0]['label'] for i in (1,3,5,7)])
+
+        # Since eye/hair color are optional, need to check that a response exists
+        # before parsing.
+        #eye_col_task=tasks[8]['value'][0]
+        #if len(eye_col_task)>1:
+        #    eye_col=eye_col_task['label']
+        #else:
+        #    eye_col='N/A'
+
+        #hair_col_task=tasks[9]['value'][0]
+        #if len(hair_col_task)>1:
+        #    hair_col=hair_col_task['label']
+        #else:
+        #    hair_col='N/A'
+    parsed=pd.DataFrame(rows,columns=value_columns+label_columns,index=chunk.index)
+    parsed.insert(0,'classification_id',chunk['classification_id'])
+    return parsed
+
+def great_circle_distance(lat1, lon1, lat2, lon2, radius=6371.):
+    # Haversine distance (in km, for the default radius) between two points given in
+    # degrees. Works on single values or on whole columns at once.
+    lat1,lon1,lat2,lon2=[np.radians(x) for x in (lat1,lon1,lat2,lon2)]
+    a=np.sin((lat2-lat1)/2.)**2+np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2.)**2
+    return 2.*radius*np.arcsin(np.sqrt(a))
+
+result_columns=['Home Latitude','Home Longitude','Institution Latitude','Institution Longitude']
+
+def get_coordinates(workflow_data, with_distance=False):
+    # Turns parsed classifications into signed coordinates for every row at once.
+    # Rows where any of the numerical inputs isn't a single number that can be mapped
+    # to a float are dropped. With with_distance set, also adds the great-circle
+    # distance between home and institution.
+    values=workflow_data[value_columns].apply(pd.to_numeric,errors='coerce')
+    labels=workflow_data[label_columns]
+
+    # Use the NSEW inputs to convert numerical values to positive/negative
+    # Since South/West lat/lons could be input as negative values, also check if
+    # the value is already the appropriate sign
+    for value_col,label_col,negative in zip(value_columns,label_columns,['South','West','South','West']):
+        flip=(values[value_col]>0)&(labels[label_col]==negative)
+        values.loc[flip,value_col]=-values.loc[flip,value_col]
+
+    values=values.dropna()
+    values.columns=result_columns
+    if with_distance:
+        values['Distance (km)']=great_circle_distance(values['Home Latitude'],values['Home Longitude'],
+                                                      values['Institution Latitude'],values['Institution Longitude'])
+    return values.reset_index(drop=True)
 
 infile='introduction-to-the-zoo-tools-classifications.csv'
 outfile='zoo_tools_results.csv'
 workflow='workflow v4 - use this'
-all_data=pd.read_csv(infile)
-workflow_data=all_data.groupby('workflow_name').get_group(workflow)
-results=pd.DataFrame({'Home Latitude':[],
-                     'Home Longitude':[],
-                     'Institution Latitude':[],
-                     'Institution Longitude':[]
-                     })
-for i in range(len(workflow_data)):
-    tasks=pd.read_json(workflow_data['annotations'].iloc[i])['value'].iloc[0]
-
-    # Since tasks alternate numerical values / NSEW options,
-    # even indices give numerical values, odd indices give NSEW choices
-    home_lat,home_lon,inst_lat,inst_lon=[tasks[i]['value'] for i in (0,2,4,6)]
-    home_lat_ns,home_lon_ew,inst_lat_ns,inst_lon_ew=[tasks[i]['value'][0]['label'] for i in (1,3,5,7)]
-
-    # Since eye/hair color are optional, need to check that a response exists
-    # before parsing.
-    #eye_col_task=tasks[8]['value'][0]
-    #if len(eye_col_task)>1:
-    #    eye_col=eye_col_task['label']
-    #else:
-    #    eye_col='N/A'
-
-    #hair_col_task=tasks[9]['value'][0]
-    #if len(hair_col_task)>1:
-    #    hair_col=hair_col_task['label']
-    #else:
-    #    hair_col='N/A'
-
-    # Check that all numerical inputs are a single number that can be mapped to a float
-    if all([check_input(x) for x in (home_lat,home_lon,inst_lat,inst_lon)]):
-        home_lat,home_lon,inst_lat,inst_lon=map(float,[home_lat,home_lon,inst_lat,inst_lon])
-
-        # Use the NSEW inputs to convert numerical values to positive/negative
-        # Since South/West lat/lons could be input as negative values, also check if
-        # the value is already the appropriate sign
-        if home_lat >0 and home_lat_ns=='South':
-            home_lat=-home_lat
-        if home_lon >0 and home_lon_ew=='West':
-            home_lon=-home_lon
-        if inst_lat >0 and inst_lat_ns=='South':
-            inst_lat=-inst_lat
-        if inst_lon >0 and inst_lon_ew=='West':
-            inst_lon=-inst_lon
-
-        new_row=pd.DataFrame({'Home Latitude':[home_lat],
-                     'Home Longitude':[home_lon],
-                     'Institution Latitude':[inst_lat],
-                     'Institution Longitude':[inst_lon]
-                     })
-        results=pd.concat([results,new_row])
-
-
-# Correctly reorders columns and resets indices for neatness
-results=results[['Home Latitude',
-                 'Home Longitude',
-                 'Institution Latitude',
-                 'Institution Longitude']].reset_index(drop=True)
-results.to_csv(outfile,index=False)
+
+# In incremental mode, results so far are saved to state_dir, and each rerun
+# only parses classifications added to the export since the last run. Changing
+# with_distance makes the next run start over.
+incremental=False
+state_dir='reduction_state'
+
+# Set to also output the distance (km) between each person's home and institution
+with_distance=False
+
+# Where to cache the parsed export as Parquet, and how many processes to parse it
+# with (see parquet_cache.load_classifications). None for neither.
+parquet_cache_dir=None
+parse_workers=None
+
+# Instrumentation (see instrumentation.py), e.g. report_file='zoo_tools_report.json',
+# profile_file='zoo_tools.prof'
+report_file=None
+trace_memory=False
+profile_file=None
+
+def main(infile=infile,outfile=outfile,workflow=workflow,incremental=incremental,state_dir=state_dir,
+         parquet_cache_dir=parquet_cache_dir,with_distance=with_distance,parse_workers=parse_workers,
+         report_file=report_file,trace_memory=trace_memory,profile_file=profile_file,instrumentation=None):
+    # Runs the whole reduction with the settings above (any of which can be overridden),
+    # recording each stage in instrumentation (a new Instrumentation if not given).
+    # Returns the results dataframe.
+    instr=instrumentation or Instrumentation('zoo-tools',trace_memory)
+    with profiled(profile_file):
+        state=ReductionState(state_dir,'zoo_tools',workflow,infile,{'with_distance':with_distance}) if incremental else None
+        with instr.stage('load') as stage:
+            workflow_data=load_classifications(infile,workflow,parse_tasks,raw_columns,parsed_columns,
+                                               after_id=state.last_id if state else None,
+                                               parquet_cache_dir=parquet_cache_dir,workers=parse_workers)
+            stage['rows']=len(workflow_data)
+
+        # Get everyone's coordinates, dropping any invalid inputs
+        with instr.stage('aggregate') as stage:
+            results=get_coordinates(workflow_data,with_distance)
+            stage['rows']=len(results)
+
+        # Add the new results on to those from previous runs
+        if incremental:
+            with instr.stage('merge') as stage:
+                previous=state.load_table()
+                if previous is not None:
+                    results=pd.concat([previous,results]).reset_index(drop=True)
+                state.save(results,workflow_data['classification_id'])
+                stage['rows']=len(results)
+
+        with instr.stage('write') as stage:
+            results.to_csv(outfile,index=False)
+            stage['rows']=len(results)
+
+    if report_file:
+        instr.write(report_file)
+    return results
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,177 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Writes fake Panoptes classification exports for each of the workflows the reductions
+# handle, so they can be run (and timed) without a real class's data:
+#   intro2astro-hubbles-law-classifications.csv      - Hubble's law line marks
+#   galaxy-zoo-in-astronomy-101-classifications.csv  - Galaxy Zoo morphology votes
+#   introduction-to-the-zoo-tools-classifications.csv - zoo tools lat/lon answers
+# The files have the same names, columns and JSON layout as the real exports, so the
+# scripts can be run on them as they are. Some classifications belong to other
+# workflows, and some are badly formed, as in real exports. The Galaxy Zoo galaxies'
+# SDSS data is written to sdss_<table>.csv, to use with load_local_sdss.
+#   python make_synthetic_exports.py --rows 100000 --subjects 2000 --outdir synthetic
+
+hubble_file='intro2astro-hubbles-law-classifications.csv'
+gzoo_file='galaxy-zoo-in-astronomy-101-classifications.csv'
+zoo_tools_file='introduction-to-the-zoo-tools-classifications.csv'
+sdss_tables=['photoobjall', 'specobjall', 'zooVotes']
+
+hubble_workflow='NU Highlights of Astronomy'
+gzoo_workflow='NU Highlights of Astronomy'
+zoo_tools_workflow='workflow v4 - use this'
+
+def _base_columns(rng, n_rows, workflow, other_workflow, other_fraction, start='2016-10-17'):
+    # The columns every export has: ids, users, workflows and timestamps. Classifications
+    # are spread over ten weeks, in order of classification_id.
+    seconds=np.sort(rng.uniform(0, 70*86400, n_rows)).astype('int64')
+    created_at=pd.Timestamp(start)+pd.to_timedelta(seconds, unit='s')
+    user_ids=rng.randint(1, max(2, n_rows//20), n_rows)
+    workflows=np.where(rng.random_sample(n_rows)<other_fraction, other_workflow, workflow)
+    return pd.DataFrame({'classification_id' : np.arange(1, n_rows+1)+10000000,
+                         'user_name'         : ['student{0}'.format(i) for i in user_ids],
+                         'user_id'           : user_ids,
+                         'workflow_id'       : np.where(workflows==workflow, 1001, 1002),
+                         'workflow_name'     : workflows,
+                         'workflow_version'  : '12.3',
+                         'created_at'        : created_at.strftime('%Y-%m-%d %H:%M:%S UTC')})
+
+def make_hubble_export(path, n_rows, n_subjects, seed=0, other_fraction=0.1, bad_fraction=0.05):
+    # Line marks on galaxy spectra. Each galaxy has a redshift, and students mark the
+    # redshifted Ca K line (393.4nm at rest), scattered by a few nm. Some windows were
+    # resized, which shows up in naturalWidth. bad_fraction of the marks are missing
+    # their width or have no mark at all.
+    rng=np.random.RandomState(seed)
+    data=_base_columns(rng, n_rows, hubble_workflow, 'Hubble practice', other_fraction)
+    subject_ids=np.arange(n_subjects)+200000
+    redshift=rng.uniform(0.005, 0.2, n_subjects)
+    ra=np.round(rng.uniform(0, 360, n_subjects), 5)
+    dec=np.round(rng.uniform(-10, 70, n_subjects), 5)
+    elliptical=rng.random_sample(n_subjects)<0.4
+    subject_data=['{{"{0}": {{"RA": {1!r}, "Dec": {2!r}, "Redshift": {3!r}, "dr7objid": {4}, "elliptical": {5}, "image": "{0}.png"}}}}'.format(
+                   sid, r, d, z, 587722981736000000+sid, 'true' if e else 'false')
+                  for sid,r,d,z,e in zip(subject_ids, ra.tolist(), dec.tolist(), redshift.tolist(), elliptical)]
+
+    subject=rng.randint(0, n_subjects, n_rows)
+    nw=rng.choice([1152, 1152, 1152, 960], n_rows)
+    xmin=np.trunc((108./1152.)*nw)
+    xmax=np.trunc((1081./1152.)*nw)
+    width=rng.uniform(4., 30., n_rows)
+    lambdacen=393.4*(1.+redshift[subject])+rng.normal(0., 2., n_rows)
+    xleft=(lambdacen-380.)*(xmax-xmin)/120.+xmin-width/2.
+    bad=rng.random_sample(n_rows)
+    mark='[{{"x": {0!r}, "y": 112.5, "tool": 0, "frame": 0, "width": {1!r}, "height": 60, "details": []}}]'
+    no_width='[{{"x": {0!r}, "y": 112.5, "tool": 0, "frame": 0, "details": []}}]'
+    annotations=[]
+    for x,w,b in zip(xleft.tolist(), width.tolist(), bad):
+        if b<bad_fraction/2.:
+            marks='[]'
+        elif b<bad_fraction:
+            marks=no_width.format(x)
+        else:
+            marks=mark.format(x, w)
+        annotations.append('[{"task": "T0", "task_label": "Mark the Calcium K line", "value": '+marks+'}]')
+    metadata=['{{"source": "api", "session": "s", "subject_dimensions": [{{"clientWidth": 800, "clientHeight": 400, "naturalWidth": {0}, "naturalHeight": 500}}]}}'.format(n)
+              for n in nw]
+
+    data['metadata']=metadata
+    data['annotations']=annotations
+    data['subject_data']=[subject_data[i] for i in subject]
+    data['subject_ids']=subject_ids[subject]
+    data.to_csv(path, index=False)
+
+def make_gzoo_export(path, n_rows, n_subjects, seed=0, other_fraction=0.1):
+    # Morphology votes on galaxy images. Each galaxy has a most likely type, and votes
+    # are drawn around it. Returns a dataframe of the galaxies' SDSS data, with each
+    # column of sdss_queries.lookups plus an objid column.
+    rng=np.random.RandomState(seed)
+    choices=np.array(['Spiral', 'Elliptical', 'Merger', 'Star/artifact'])
+    data=_base_columns(rng, n_rows, gzoo_workflow, 'Galaxy Zoo practice', other_fraction)
+    subject_ids=np.arange(n_subjects)+500000
+    objids=np.arange(n_subjects, dtype='int64')+1237648720693755000
+    probs=rng.dirichlet([4., 3., 1., 0.5], n_subjects)
+    subject_data=['{{"{0}": {{"retired": null, "image_file": "{1}.jpeg"}}}}'.format(sid, obj)
+                  for sid,obj in zip(subject_ids, objids)]
+
+    subject=rng.randint(0, n_subjects, n_rows)
+    cumulative=probs.cumsum(axis=1)[subject]
+    choice=(rng.random_sample((n_rows, 1))>cumulative).sum(axis=1).clip(max=len(choices)-1)
+    data['metadata']='{"source": "api", "session": "s"}'
+    data['annotations']=['[{{"task": "T0", "task_label": "What type of galaxy is this?", "value": "{0}"}}]'.format(c)
+                         for c in choices[choice]]
+    data['subject_data']=[subject_data[i] for i in subject]
+    data['subject_ids']=subject_ids[subject]
+    data.to_csv(path, index=False)
+
+    # Every galaxy has magnitudes, but not every one has a spectrum or was in the
+    # original Galaxy Zoo
+    sdss=pd.DataFrame({'objid'      : objids,
+                       'modelmag_g' : rng.uniform(14., 18., n_subjects),
+                       'modelmag_r' : rng.uniform(13., 17., n_subjects),
+                       'z'          : np.where(rng.random_sample(n_subjects)<0.9, rng.uniform(0.01, 0.2, n_subjects), np.nan),
+                       'nvote_std'  : np.where(rng.random_sample(n_subjects)<0.8, rng.randint(10, 80, n_subjects), -1)})
+    original=rng.dirichlet([1., 1., 1., 1.], n_subjects).round(3)
+    for i,col in enumerate(['p_el', 'p_cs', 'p_mg', 'p_dk']):
+        sdss[col]=original[:,i]
+    return sdss
+
+def make_zoo_tools_export(path, n_rows, seed=0, other_fraction=0.1, bad_fraction=0.05):
+    # Answers to the zoo tools tutorial: the latitude and longitude of each student's
+    # home and institution, each followed by a North/South or East/West choice. Some
+    # numbers are given as negative values, and bad_fraction of them can't be read.
+    rng=np.random.RandomState(seed)
+    data=_base_columns(rng, n_rows, zoo_tools_workflow, 'workflow v3', other_fraction)
+    lat=rng.uniform(-60., 70., (n_rows, 2))
+    lon=rng.uniform(-180., 180., (n_rows, 2))
+    unsigned=rng.random_sample((n_rows, 4))<0.7
+    bad=rng.random_sample((n_rows, 4))
+    annotations=[]
+    for i in range(n_rows):
+        answers=[]
+        for k,(value,pos,neg) in enumerate([(lat[i,0], 'North', 'South'), (lon[i,0], 'East', 'West'),
+                                            (lat[i,1], 'North', 'South'), (lon[i,1], 'East', 'West')]):
+            if bad[i,k]<bad_fraction/2.:
+                text=''
+            elif bad[i,k]<bad_fraction:
+                text='{0:.0f} {1}'.format(abs(value), pos[0] if value>0 else neg[0])
+            else:
+                text=str(round(abs(value) if unsigned[i,k] else value, 3))
+            answers.append({'task' : 'T{0}'.format(2*k), 'value' : text})
+            answers.append({'task' : 'T{0}'.format(2*k+1), 'value' : [{'value' : 0 if value>0 else 1, 'label' : pos if value>0 else neg}]})
+        annotations.append(json.dumps([{'task' : 'T0', 'value' : answers}]))
+    data['metadata']='{"source": "api", "session": "s"}'
+    data['annotations']=annotations
+    data['subject_data']='{"1234": {"retired": null}}'
+    data['subject_ids']=1234
+    data.to_csv(path, index=False)
+
+def make_exports(outdir, n_rows, n_subjects, seed=0):
+    # Writes all three exports, and the SDSS tables for the Galaxy Zoo galaxies, to outdir
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    make_hubble_export(os.path.join(outdir, hubble_file), n_rows, n_subjects, seed)
+    sdss=make_gzoo_export(os.path.join(outdir, gzoo_file), n_rows, n_subjects, seed)
+    make_zoo_tools_export(os.path.join(outdir, zoo_tools_file), n_rows, seed)
+    sdss[['objid', 'modelmag_g', 'modelmag_r']].to_csv(os.path.join(outdir, 'sdss_photoobjall.csv'), index=False)
+    sdss.loc[sdss['z'].notnull(), ['objid', 'z']].rename(columns={'objid' : 'bestobjid'}).to_csv(
+        os.path.join(outdir, 'sdss_specobjall.csv'), index=False)
+    sdss.loc[sdss['nvote_std']>=0, ['objid', 'nvote_std', 'p_el', 'p_cs', 'p_mg', 'p_dk']].to_csv(
+        os.path.join(outdir, 'sdss_zooVotes.csv'), index=False)
+
+def load_local_sdss(outdir, latency=0.):
+    # Returns a sdss_queries.LocalSDSS serving the SDSS tables written by make_exports
+    from sdss_queries import LocalSDSS
+    tables=dict((table, pd.read_csv(os.path.join(outdir, 'sdss_'+table+'.csv'))) for table in sdss_tables)
+    return LocalSDSS(latency=latency, **tables)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Write synthetic Panoptes classification exports')
+    parser.add_argument('--rows', type=int, default=100000, help='number of classifications in each export')
+    parser.add_argument('--subjects', type=int, default=2000, help='number of galaxies in the Hubble and Galaxy Zoo exports')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--outdir', default='synthetic', help='directory to write the exports to')
+    args=parser.parse_args()
+    make_exports(args.outdir, args.rows, args.subjects, args.seed)
@@ -0,0 +1,90 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+# orjson is much faster at decoding annotation strings, but is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Number of rows of the raw export held in memory at once
+default_chunksize=20000
+
+def to_utc(time):
+    # Panoptes timestamps are UTC, so naive start/end times are taken to be UTC as well
+    time=pd.Timestamp(time)
+    if time.tzinfo is None:
+        return time.tz_localize('UTC')
+    return time.tz_convert('UTC')
+
+def read_workflow(infile, workflow_name, columns=None, start=None, end=None, chunksize=default_chunksize, after_id=None):
+    # Reads a Panoptes classification export in chunks, and yields only the rows
+    # belonging to workflow_name. If start and/or end are given, only classifications
+    # created at or after start and before end are kept, and if after_id is given only
+    # those with a classification_id greater than after_id. If columns is given, only
+    # those columns are read from the file (plus any needed for filtering, which are
+    # dropped again before the chunk is yielded).
+    filter_cols=['workflow_name']
+    if start is not None or end is not None:
+        filter_cols.append('created_at')
+    if after_id is not None:
+        filter_cols.append('classification_id')
+    usecols=None
+    if columns is not None:
+        usecols=list(columns)+[col for col in filter_cols if col not in columns]
+
+    for chunk in pd.read_csv(infile, usecols=usecols, chunksize=chunksize):
+        mask=(chunk['workflow_name']==workflow_name)
+        if after_id is not None:
+            mask&=(chunk['classification_id']>after_id)
+        if start is not None or end is not None:
+            created_at=pd.to_datetime(chunk['created_at'], utc=True)
+            if start is not None:
+                mask&=(created_at>=to_utc(start))
+            if end is not None:
+                mask&=(created_at<to_utc(end))
+        chunk=chunk.loc[mask]
+        if columns is not None:
+            chunk=chunk[list(columns)]
+        if len(chunk):
+            yield chunk
+
+def map_chunks(transform, chunks, workers=None):
+    # Applies transform to each chunk, yielding the results in the same order as the
+    # chunks. With workers>1, the chunks are transformed in a pool of that many
+    # processes while this process keeps reading, with at most 2*workers chunks in
+    # flight at once. transform has to be picklable (i.e. a module-level function),
+    # and scripts using this need an if __name__=='__main__': guard.
+    if not workers or workers<=1:
+        for chunk in chunks:
+            yield transform(chunk)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending=deque()
+        for chunk in chunks:
+            pending.append(pool.submit(transform, chunk))
+            if len(pending)>=2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def load_workflow(infile, workflow_name, columns=None, start=None, end=None, chunksize=default_chunksize, transform=None, after_id=None, workers=None):
+    # Reads all of a workflow's classifications with read_workflow, and returns them
+    # as a single dataframe. If transform is given, it's applied to each chunk as it's
+    # read, so only its (usually much smaller) output is held in memory. With workers
+    # set, the chunks are transformed in that many processes (see map_chunks); the
+    # result is the same as without.
+    # When reading only classifications after after_id there may be none, in which
+    # case an empty dataframe is returned rather than raising a KeyError.
+    chunks=read_workflow(infile, workflow_name, columns, start, end, chunksize, after_id)
+    if transform is None:
+        parts=list(chunks)
+    else:
+        parts=list(map_chunks(transform, chunks, workers))
+    if not parts:
+        if after_id is None:
+            raise KeyError('No classifications found for workflow '+repr(workflow_name))
+        empty=pd.DataFrame(columns=columns)
+        return empty if transform is None else transform(empty)
+    return pd.concat(parts)
@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import hashlib
+from functools import partial
+import pandas as pd
+from panoptes_io import read_workflow, load_workflow, map_chunks, to_utc
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+# Turning the raw CSV and JSON annotation strings into structured columns is the
+# expensive step of every reduction. This caches the parsed columns of a Panoptes
+# export as Parquet, one directory per input file and parser, partitioned by workflow:
+#   cache_dir/<export file name>.<parser name>/workflow_name=<workflow>/part-0.parquet
+# A workflow's partition is built the first time it's asked for. The input file's
+# size, modification time and SHA-256 hash are stored with the cache, and if the file
+# has changed, every partition is thrown out and rebuilt.
+# Reading and writing Parquet needs pyarrow, which is only imported when used.
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('The Parquet cache requires pyarrow (pip install pyarrow)')
+    return pyarrow, pyarrow.parquet
+
+def file_hash(filename, block_size=2**20):
+    sha=hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _check_source(infile, root):
+    # Makes sure the cache at root was built from the current contents of infile,
+    # clearing it out if not. Only rehashes the file if its size or mtime changed.
+    stat=os.stat(infile)
+    source_file=os.path.join(root, '_source.json')
+    source={'infile' : os.path.abspath(infile), 'size' : stat.st_size, 'mtime' : stat.st_mtime}
+    if os.path.exists(source_file):
+        with open(source_file, 'r') as f:
+            cached=json.load(f)
+        if all(cached[key]==source[key] for key in source):
+            return
+        source['sha256']=file_hash(infile)
+        if cached['sha256']!=source['sha256']:
+            shutil.rmtree(root)
+    else:
+        source['sha256']=file_hash(infile)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    with open(source_file, 'w') as f:
+        json.dump(source, f)
+
+def _parse_chunk(parser, chunk):
+    parsed=parser(chunk)
+    parsed['created_at']=pd.to_datetime(chunk['created_at'], utc=True)
+    return parsed
+
+def build_partition(infile, workflow_name, parser, raw_columns, path, workers=None):
+    # Parses every classification in a workflow and writes the result to path.
+    # parser takes a chunk of the raw export (with raw_columns) and returns a dataframe
+    # with one row per classification. created_at is added so reads can filter on time.
+    # With workers set, chunks are parsed in that many processes (see panoptes_io.map_chunks).
+    pa,pq=_import_pyarrow()
+    columns=list(raw_columns)+[col for col in ['created_at'] if col not in raw_columns]
+    chunks=read_workflow(infile, workflow_name, columns=columns)
+    parts=list(map_chunks(partial(_parse_chunk, parser), chunks, workers))
+    if not parts:
+        raise KeyError('No classifications found for workflow '+repr(workflow_name))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    table=pa.Table.from_pandas(pd.concat(parts), preserve_index=False)
+    pq.write_table(table, path+'.tmp')
+    os.rename(path+'.tmp', path)
+
+def load_parsed(infile, workflow_name, parser, raw_columns, cache_dir='parsed_cache',
+                columns=None, start=None, end=None, after_id=None, workers=None):
+    # Returns the parsed classifications for a workflow from the cache, building it
+    # first if needed (parsing in workers processes, if given). Takes the same filtering
+    # arguments as panoptes_io.load_workflow, and only the given columns are read
+    # (memory mapped) from the Parquet file.
+    pa,pq=_import_pyarrow()
+    root=os.path.join(cache_dir, os.path.basename(infile)+'.'+parser.__name__)
+    _check_source(infile, root)
+    path=os.path.join(root, 'workflow_name='+quote(workflow_name, safe=''), 'part-0.parquet')
+    if not os.path.exists(path):
+        build_partition(infile, workflow_name, parser, raw_columns, path, workers)
+
+    read_columns=None
+    if columns is not None:
+        read_columns=list(columns)+[col for col in ['created_at'] if col not in columns and (start is not None or end is not None)]
+    filters=None
+    if after_id is not None:
+        filters=[('classification_id', '>', after_id)]
+    data=pq.read_table(path, columns=read_columns, filters=filters, memory_map=True).to_pandas()
+
+    if start is not None or end is not None:
+        mask=pd.Series(True, index=data.index)
+        if start is not None:
+            mask&=(data['created_at']>=to_utc(start))
+        if end is not None:
+            mask&=(data['created_at']<to_utc(end))
+        data=data.loc[mask]
+    if columns is not None:
+        data=data[list(columns)]
+    return data
+
+def load_classifications(infile, workflow, parser, raw_columns, parsed_columns, start=None, end=None,
+                         after_id=None, parquet_cache_dir=None, workers=None):
+    # How every reduction loads its classifications: the parsed_columns of parser's
+    # output for a workflow, filtered like panoptes_io.load_workflow. With
+    # parquet_cache_dir set (e.g. 'parsed_cache'), the parsed classifications are kept
+    # there as Parquet, so later runs don't have to parse the export again (needs
+    # pyarrow). Otherwise the raw export (raw_columns of it) is streamed through parser.
+    # With workers set (e.g. 4), the export is parsed in that many processes, which is
+    # faster for very large exports; the result is the same either way.
+    if parquet_cache_dir:
+        return load_parsed(infile, workflow, parser, raw_columns, parquet_cache_dir, columns=parsed_columns,
+                           start=start, end=end, after_id=after_id, workers=workers)
+    data=load_workflow(infile, workflow, columns=raw_columns, start=start, end=end, transform=parser,
+                       after_id=after_id, workers=workers)
+    return data[list(parsed_columns)]
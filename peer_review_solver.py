@@ -0,0 +1,135 @@
+import numpy as np
+
+# Assigns peer reviews without the random restarts of the original loop.
+#
+# Every student reviews reviews_per_student videos, each from a different group and
+# never their own, and every group's video is reviewed the same number of times (some
+# groups get one extra review when the total doesn't divide evenly, as before, but
+# which groups get the extras is left free, so more group layouts can be solved).
+#
+# Students in the same group are interchangeable, so this is solved at the level of
+# groups: x[h,g] is the number of reviews students from group h do of group g's video.
+# x has to fill each group's quota of reviews, give group h exactly
+# reviews_per_student*n_h reviews to do, have a zero diagonal, and have no entry above
+# n_h, so that each student of h can review g at most once. That's a max-flow problem,
+# which is solved by filling x greedily and then fixing any shortfall with augmenting
+# paths. Finally each group's reviews are dealt out to its students so that no student
+# gets the same video twice. The work is bounded, roughly
+# O(students*groups + groups^2*shortfall), with no retrying.
+
+class _Quotas(object):
+    # Reviews still to be handed out for each group's video: every group gets at least
+    # num_reviews//num_groups, and num_reviews%num_groups groups get one extra.
+    def __init__(self, num_groups, num_reviews):
+        self.remaining=np.zeros(num_groups, dtype=int)+num_reviews//num_groups
+        self.extras=num_reviews%num_groups
+        self.took_extra=np.zeros(num_groups, dtype=bool)
+
+    def available(self):
+        # Reviews each group's video can still take
+        if self.extras>0:
+            return self.remaining+~self.took_extra
+        return self.remaining
+
+    def take(self, groups):
+        for g in groups:
+            if self.remaining[g]>0:
+                self.remaining[g]-=1
+            else:
+                self.took_extra[g]=True
+                self.extras-=1
+
+def _greedy_fill(x, sizes, quotas, reviews_per_student, rng):
+    # Gives each student, in turn, the groups with the most reviews still to be handed
+    # out (ties broken at random). Only fills the minimum quotas; the extra reviews are
+    # handed out by _augment. Returns how many reviews each group is still short.
+    num_groups=len(sizes)
+    shortfall=np.zeros(num_groups, dtype=int)
+    for h in np.argsort(-sizes, kind='mergesort'):
+        for student in range(sizes[h]):
+            score=quotas.remaining+0.5*rng.random_sample(num_groups)
+            score[h]=-1.
+            score[quotas.remaining<=0]=-1.
+            choices=np.argsort(-score)[:reviews_per_student]
+            choices=choices[score[choices]>=0]
+            x[h,choices]+=1
+            quotas.take(choices)
+            shortfall[h]+=reviews_per_student-len(choices)
+    return shortfall
+
+def _augment(x, sizes, quotas, shortfall):
+    # Finds one augmenting path from a group that is short of reviews to do, to a group
+    # whose video still has reviews to hand out, and moves one review along it.
+    # Returns False if there is no such path, i.e. no valid assignment exists.
+    num_groups=len(sizes)
+    available=quotas.available()
+    from_row=-np.ones(num_groups, dtype=int) # for each group's video, the reviewing group it was reached from
+    from_col=-np.ones(num_groups, dtype=int) # for each reviewing group, the video it was reached from
+    seen_rows=shortfall>0
+    seen_cols=np.zeros(num_groups, dtype=bool)
+    frontier=list(np.nonzero(seen_rows)[0])
+    while frontier:
+        new_cols=[]
+        for h in frontier:
+            # Group h can take on one more review of g
+            cols=np.nonzero(~seen_cols & (x[h]<sizes[h]))[0]
+            cols=cols[cols!=h]
+            seen_cols[cols]=True
+            from_row[cols]=h
+            done=cols[available[cols]>0]
+            if len(done):
+                g=done[0]
+                quotas.take([g])
+                while True:
+                    h=from_row[g]
+                    x[h,g]+=1
+                    if from_col[h]<0:
+                        shortfall[h]-=1
+                        return True
+                    g=from_col[h]
+                    x[h,g]-=1
+            new_cols.extend(cols)
+        frontier=[]
+        for g in new_cols:
+            # Some other group could give up one of its reviews of g
+            rows=np.nonzero(~seen_rows & (x[:,g]>0))[0]
+            seen_rows[rows]=True
+            from_col[rows]=g
+            frontier.extend(rows)
+    return False
+
+def assign_reviews(students, reviews_per_student=2, seed=None):
+    # students is a list of (name, group number) tuples. Returns a list, in the same
+    # order, of (name, group, [sorted list of groups whose videos to review]).
+    # Pass a seed to get the same assignments every time.
+    # Raises a ValueError if no valid assignment exists (e.g. one group is too big).
+    rng=np.random.RandomState(seed)
+    group_ids=sorted(set(stdnt[1] for stdnt in students))
+    num_groups=len(group_ids)
+    if num_groups-1<reviews_per_student:
+        raise ValueError('Need at least {0} groups for {1} reviews per student'.format(
+                         reviews_per_student+1, reviews_per_student))
+    group_index=dict((group,i) for i,group in enumerate(group_ids))
+    members=[[] for group in group_ids]
+    for i,stdnt in enumerate(students):
+        members[group_index[stdnt[1]]].append(i)
+    sizes=np.array([len(m) for m in members])
+
+    quotas=_Quotas(num_groups, reviews_per_student*len(students))
+    x=np.zeros((num_groups, num_groups), dtype=int)
+    shortfall=_greedy_fill(x, sizes, quotas, reviews_per_student, rng)
+    while shortfall.sum()>0:
+        if not _augment(x, sizes, quotas, shortfall):
+            raise ValueError('No valid peer-review assignment exists for these groups')
+
+    # Deal out each group's reviews. Writing the reviews out with each video's reviews
+    # together, student i gets entries i, i+n, i+2n, ..., so since no video appears more
+    # than n times, no student gets the same video twice.
+    reviews=[None]*len(students)
+    for h in range(num_groups):
+        order=rng.permutation(num_groups)
+        layout=np.repeat(order, x[h,order])
+        group_members=[members[h][i] for i in rng.permutation(sizes[h])]
+        for i,stdnt in enumerate(group_members):
+            reviews[stdnt]=sorted(group_ids[g] for g in layout[i::sizes[h]])
+    return [(stdnt[0], stdnt[1], reviews[i]) for i,stdnt in enumerate(students)]
@@ -0,0 +1,58 @@
+from collections import Counter
+import numpy as np
+
+# Checks a set of peer-review assignments and summarizes how the reviews are spread
+# over the groups, in a single pass over the assignments.
+
+def validate_assignments(results, reviews_per_student=None):
+    # results is the output of peer_review_solver.assign_reviews, a list of
+    # (name, group, [list of groups whose videos to review]). If reviews_per_student is
+    # given, every student is also checked to have exactly that many reviews.
+    # Returns a dict with:
+    #   valid              - True if there are no violations of any kind
+    #   balanced           - True if every group's video is reviewed the same number of
+    #                        times, give or take one
+    #   num_students, num_groups
+    #   reviews_per_group  - {group : number of times its video is reviewed}, for every
+    #                        group that has students or is reviewed
+    #   load               - min, max, mean and std of reviews_per_group
+    #   unreviewed_groups  - groups whose video nobody reviews
+    #   self_reviews       - names of students assigned their own group's video
+    #   duplicate_reviews  - names of students assigned the same video more than once
+    #   wrong_review_count - names of students without reviews_per_student reviews
+    reviews_per_group=Counter()
+    self_reviews=[]
+    duplicate_reviews=[]
+    wrong_review_count=[]
+    groups=set()
+    for name,group,reviews in results:
+        groups.add(group)
+        reviews_per_group.update(reviews)
+        if group in reviews:
+            self_reviews.append(name)
+        if len(set(reviews))!=len(reviews):
+            duplicate_reviews.append(name)
+        if reviews_per_student is not None and len(reviews)!=reviews_per_student:
+            wrong_review_count.append(name)
+    groups.update(reviews_per_group)
+    groups=sorted(groups)
+
+    counts=np.array([reviews_per_group[group] for group in groups])
+    unreviewed_groups=[group for group in groups if reviews_per_group[group]==0]
+    if len(counts):
+        load={'min' : int(counts.min()), 'max' : int(counts.max()),
+              'mean' : float(counts.mean()), 'std' : float(counts.std())}
+    else:
+        load={'min' : 0, 'max' : 0, 'mean' : 0., 'std' : 0.}
+    balanced=load['max']-load['min']<=1
+
+    return {'valid' : balanced and not (unreviewed_groups or self_reviews or duplicate_reviews or wrong_review_count),
+            'balanced' : balanced,
+            'num_students' : len(results),
+            'num_groups' : len(groups),
+            'reviews_per_group' : dict((group, reviews_per_group[group]) for group in groups),
+            'load' : load,
+            'unreviewed_groups' : unreviewed_groups,
+            'self_reviews' : self_reviews,
+            'duplicate_reviews' : duplicate_reviews,
+            'wrong_review_count' : wrong_review_count}
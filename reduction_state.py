@@ -0,0 +1,52 @@
+import os
+import re
+import json
+import pandas as pd
+
+# Saved state of an incremental reduction. Classification exports only ever grow
+# during an assignment, so instead of reparsing every row on each run we keep, for
+# each reduction and workflow, the last classification_id processed plus a table of
+# running per-subject aggregates (counts, sums, vote tallies, ...). A rerun then only
+# parses classifications newer than last_id, and merges them into the table.
+# State is kept as a .json checkpoint and a .csv table in state_dir. settings is a
+# dict of anything that changes which classifications are aggregated or what's kept
+# for each one (e.g. a time window), and is saved with the checkpoint. If the state
+# was saved from a different input file or with different settings, it is ignored and
+# the reduction starts over, rather than mixing rows reduced two different ways.
+class ReductionState(object):
+    def __init__(self, state_dir, reduction, workflow_name, infile, settings=None):
+        self.state_dir=state_dir
+        self.infile=infile
+        # Stored the way it will read back from the .json file, so the two compare equal
+        self.settings=json.loads(json.dumps(settings or {}, default=str))
+        slug=re.sub(r'[^A-Za-z0-9]+', '_', workflow_name).strip('_')
+        base=os.path.join(state_dir, reduction+'_'+slug)
+        self.meta_file=base+'.json'
+        self.table_file=base+'.csv'
+        self.last_id=None
+
+        if os.path.exists(self.meta_file) and os.path.exists(self.table_file):
+            with open(self.meta_file, 'r') as f:
+                meta=json.load(f)
+            if meta['infile']==infile and meta.get('settings', {})==self.settings:
+                self.last_id=meta['last_classification_id']
+
+    def load_table(self, dtype=None):
+        # Returns the stored aggregates table, or None if there's no saved state
+        if self.last_id is None:
+            return None
+        return pd.read_csv(self.table_file, index_col=0, dtype=dtype, float_precision='round_trip')
+
+    def save(self, table, new_ids):
+        # Stores the merged aggregates table, and moves the checkpoint past new_ids,
+        # the classification_ids processed in this run
+        if len(new_ids):
+            last_id=int(max(new_ids))
+            self.last_id=last_id if self.last_id is None else max(self.last_id, last_id)
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        table.to_csv(self.table_file)
+        with open(self.meta_file, 'w') as f:
+            json.dump({'infile' : self.infile,
+                       'settings' : self.settings,
+                       'last_classification_id' : self.last_id}, f)
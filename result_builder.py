@@ -0,0 +1,21 @@
+import pandas as pd
+
+# Collects output rows one at a time and builds a single dataframe at the end.
+# Appending a one-row dataframe with pd.concat copies the whole table every time,
+# so building n rows that way takes O(n^2) time. Here each row's values are just
+# appended to a list per column, and the dataframe is only created once.
+class ResultBuilder(object):
+    def __init__(self, columns):
+        self.columns=list(columns)
+        self._data=dict((col,[]) for col in self.columns)
+
+    def append(self, row):
+        # row is a dict with a value for every column
+        for col in self.columns:
+            self._data[col].append(row[col])
+
+    def __len__(self):
+        return len(self._data[self.columns[0]]) if self.columns else 0
+
+    def to_frame(self):
+        return pd.DataFrame(self._data, columns=self.columns)
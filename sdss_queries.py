@@ -0,0 +1,313 @@
+import re
+import json
+import time
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Errors worth retrying a query after: network trouble (requests' exceptions, timeouts
+# and socket errors are all IOErrors) and SkyServer reporting a problem on its end.
+# Anything else, like a malformed query, would only fail the same way again.
+retry_errors=(IOError, OSError)
+try:
+    from astroquery.exceptions import RemoteServiceError
+    retry_errors+=(RemoteServiceError,)
+except ImportError:
+    pass
+
+# Each lookup the Galaxy Zoo export needs from SDSS, keyed by query kind.
+# Values are (table, objid column, columns to return)
+lookups={'mags'     : ('photoobjall', 'objid',     ['modelmag_g','modelmag_r']),
+         'z'        : ('specobjall',  'bestobjid', ['z']),
+         'zooVotes' : ('zooVotes',    'objid',     ['nvote_std','p_el','p_cs','p_mg','p_dk'])}
+
+# astroquery sends each query to SkyServer in the URL of a GET request, and SkyServer
+# (on IIS) turns away query strings longer than 2048 characters by default, so objids
+# are sent in chunks. An objid and its URL-encoded comma take 22 characters, which
+# puts 75 ids at about 1750 characters for the longest of our queries.
+default_chunk_size=75
+
+# Raised by get_sdss_data when some lookups still failed after every retry, so that
+# galaxies SDSS couldn't be asked about aren't mistaken for ones it has no data on
+class SDSSQueryError(Exception):
+    def __init__(self, failed_ids):
+        self.failed_ids=failed_ids
+        n_failed=sum(len(ids) for ids in failed_ids.values())
+        Exception.__init__(self, '{0} SDSS objid lookups failed after every retry ({1})'.format(
+            n_failed, ', '.join(sorted(failed_ids))))
+
+def _chunks(ids, chunk_size):
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i+chunk_size]
+
+def build_query(kind, ids):
+    # Builds a single SQL query for every objid in ids
+    table,id_col,cols=lookups[kind]
+    return 'select {0},{1} from {2} where {0} in ({3})'.format(id_col, ','.join(cols), table, ','.join(ids))
+
+def query_chunk(client, kind, ids):
+    # Runs one chunk of a lookup. Returns a dataframe indexed by objid (as a string),
+    # with only the first row kept for each objid, like the old 'select top 1' queries.
+    # astroquery returns None rather than an empty table when nothing matches.
+    table,id_col,cols=lookups[kind]
+    result=client.query_sql(build_query(kind, ids))
+    if result is None:
+        return pd.DataFrame(columns=cols, index=pd.Index([], dtype=object))
+    df=result.to_pandas()
+    df.index=df[id_col].astype('int64').astype(str)
+    return df.loc[~df.index.duplicated(), cols]
+
+# Token-bucket rate limiter, shared by all worker threads. Allows `rate` queries per
+# second on average, with bursts of up to `capacity` queries.
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        self.rate=float(rate)
+        self.capacity=float(capacity)
+        self.tokens=float(capacity)
+        self.last=time.time()
+        self.lock=threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now=time.time()
+                self.tokens=min(self.capacity, self.tokens+(now-self.last)*self.rate)
+                self.last=now
+                if self.tokens>=1.:
+                    self.tokens-=1.
+                    return
+                wait=(1.-self.tokens)/self.rate
+            time.sleep(wait)
+
+# Latency and outcome of every SDSS query made during a run
+class QueryStats(object):
+    def __init__(self):
+        self.latencies=[] # (kind, number of objids, seconds) for each successful query
+        self.retries=0
+        self.failed_ids={} # kind -> objids whose query failed after every retry
+        self.lock=threading.Lock()
+
+    def record(self, kind, n_ids, seconds):
+        with self.lock:
+            self.latencies.append((kind, n_ids, seconds))
+
+    def record_retry(self):
+        with self.lock:
+            self.retries+=1
+
+    def record_failure(self, kind, ids):
+        with self.lock:
+            self.failed_ids.setdefault(kind, []).extend(ids)
+
+    def summary(self):
+        # Returns a short, printable report of query latencies and failures
+        n_failed=sum(len(ids) for ids in self.failed_ids.values())
+        lines=['SDSS queries: {0} succeeded, {1} retried, {2} objid lookups failed'.format(
+                len(self.latencies), self.retries, n_failed)]
+        if self.latencies:
+            seconds=np.array([t for _,_,t in self.latencies])
+            n_ids=sum(n for _,n,_ in self.latencies)
+            lines.append('  latency per query: median {0:.3f}s, 95th percentile {1:.3f}s, max {2:.3f}s'.format(
+                np.median(seconds), np.percentile(seconds, 95), seconds.max()))
+            lines.append('  query time per objid lookup: {0:.4f}s'.format(seconds.sum()/n_ids))
+        for kind in self.failed_ids:
+            lines.append('  failed {0} lookups: {1}'.format(kind, ' '.join(self.failed_ids[kind])))
+        return '\n'.join(lines)
+
+# Runs chunks of SDSS queries on a thread pool. Every query waits on a shared rate
+# limiter so SDSS doesn't throttle us, and a query that raises one of retry_errors is
+# retried with exponential backoff. Any other error is raised straight away. A query
+# that returns no rows is not an error, but one that still fails after max_retries is
+# recorded in stats.failed_ids rather than being silently treated as missing data.
+class QueryExecutor(object):
+    def __init__(self, max_workers=4, rate=2., burst=4, max_retries=4, backoff=1.):
+        self.max_workers=max_workers
+        self.limiter=TokenBucket(rate, burst) if rate else None
+        self.max_retries=max_retries
+        self.backoff=backoff
+        self.stats=QueryStats()
+
+    def _run(self, client, kind, ids):
+        for attempt in range(self.max_retries+1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            start=time.time()
+            try:
+                found=query_chunk(client, kind, ids)
+            except retry_errors:
+                if attempt==self.max_retries:
+                    self.stats.record_failure(kind, ids)
+                    return None
+                self.stats.record_retry()
+                time.sleep(self.backoff*2**attempt*(1.+random.random()))
+            else:
+                self.stats.record(kind, len(ids), time.time()-start)
+                return found
+
+    def run(self, client, kind, ids, chunk_size):
+        # Queries every id, and returns a list of (ids, result) for each chunk, where
+        # result is None if the query failed.
+        chunks=list(_chunks(ids, chunk_size))
+        if self.max_workers<=1:
+            return [(chunk, self._run(client, kind, chunk)) for chunk in chunks]
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            results=list(pool.map(lambda chunk: self._run(client, kind, chunk), chunks))
+        return list(zip(chunks, results))
+
+def get_sdss_data(gx_ids, client=None, chunk_size=default_chunk_size, cache=None, refresh=False, executor=None,
+                  allow_failures=False):
+    # Looks up magnitudes, redshifts and the original Galaxy Zoo votes for a list of
+    # SDSS objids, using a handful of chunked 'objid in (...)' queries instead of
+    # three queries per galaxy. Returns one dataframe with a row for each distinct
+    # objid (as a string), in the order they first appear in gx_ids. Galaxies with no
+    # matching row (e.g. no spectrum, so no redshift) get NaN for those columns.
+    # If an SDSSCache is given, only objids it hasn't seen are sent to SDSS, unless
+    # refresh is set, in which case everything is re-queried and the cache updated.
+    # Queries are run by a QueryExecutor; pass one in to control concurrency, rate
+    # limiting and retries, and to read its stats afterwards. If any query still fails
+    # after its retries, SDSSQueryError is raised once every lookup has been tried (the
+    # ones that succeeded are cached, so a rerun only re-queries the failures). With
+    # allow_failures, the galaxies whose query failed get NaN instead, and are only
+    # listed in executor.stats.failed_ids.
+    if executor is None:
+        executor=QueryExecutor()
+    gx_ids=[str(gx_id) for gx_id in gx_ids]
+    unique_ids=list(pd.unique(np.array(gx_ids, dtype=object)))
+
+    frames=[]
+    for kind in lookups:
+        cols=lookups[kind][2]
+        if cache is not None and not refresh:
+            cached=cache.get(kind, unique_ids)
+        else:
+            cached=pd.DataFrame(columns=cols, index=pd.Index([], dtype=object))
+        missing=[gx_id for gx_id in unique_ids if gx_id not in cached.index]
+
+        parts=[cached] if len(cached) else []
+        if missing:
+            if client is None:
+                from astroquery.sdss import SDSS
+                client=SDSS
+            for chunk,found in executor.run(client, kind, missing, chunk_size):
+                if found is None:
+                    continue
+                if len(found):
+                    parts.append(found)
+                if cache is not None:
+                    cache.put(kind, chunk, found)
+        found=pd.concat(parts) if parts else cached
+        frames.append(found.reindex(unique_ids)[cols].astype(float))
+    if executor.stats.failed_ids and not allow_failures:
+        raise SDSSQueryError(executor.stats.failed_ids)
+    return pd.concat(frames, axis=1)
+
+
+# Persistent cache of SDSS lookups, stored in a SQLite file and keyed by objid and
+# query kind. DR photometry and Galaxy Zoo votes never change, so a rerun only
+# needs to query galaxies it has never seen. Objids that SDSS had no row for
+# (e.g. no redshift) are cached as well, so they aren't re-queried every run.
+# Entries older than max_age_days are ignored and evicted, and if max_entries is
+# set the oldest entries are evicted once the cache grows past it.
+class SDSSCache(object):
+    def __init__(self, path='sdss_cache.sqlite', max_age_days=None, max_entries=None):
+        self.path=path
+        self.max_age_days=max_age_days
+        self.max_entries=max_entries
+        self.conn=sqlite3.connect(path)
+        self.conn.execute('create table if not exists lookups ('
+                          'objid text, kind text, found integer, data text, fetched_at real, '
+                          'primary key (objid, kind))')
+        self.conn.execute('create index if not exists lookups_fetched_at on lookups (fetched_at)')
+        self.conn.commit()
+
+    def _oldest_allowed(self):
+        if self.max_age_days is None:
+            return 0.
+        return time.time()-self.max_age_days*86400.
+
+    def get(self, kind, ids):
+        # Returns a dataframe of cached rows for the given objids, indexed by objid.
+        # Cached misses come back as all-NaN rows; objids not in the cache are left out.
+        cols=lookups[kind][2]
+        index=[]
+        rows=[]
+        for chunk in _chunks(ids, default_chunk_size):
+            query='select objid, found, data from lookups where kind=? and fetched_at>=? and objid in ({0})'
+            cursor=self.conn.execute(query.format(','.join('?'*len(chunk))), [kind, self._oldest_allowed()]+list(chunk))
+            for objid,found,data in cursor:
+                index.append(objid)
+                rows.append(json.loads(data) if found else len(cols)*[np.nan])
+        return pd.DataFrame(rows, columns=cols, index=pd.Index(index, dtype=object))
+
+    def put(self, kind, ids, found):
+        # Stores the result of querying ids. found is the dataframe returned by
+        # query_chunk, and any id not in it is stored as a miss.
+        cols=lookups[kind][2]
+        now=time.time()
+        entries=[]
+        for objid in ids:
+            if objid in found.index:
+                entries.append((objid, kind, 1, json.dumps([float(v) for v in found.loc[objid, cols]]), now))
+            else:
+                entries.append((objid, kind, 0, None, now))
+        self.conn.executemany('insert or replace into lookups values (?,?,?,?,?)', entries)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        if self.max_age_days is not None:
+            self.conn.execute('delete from lookups where fetched_at<?', [self._oldest_allowed()])
+        if self.max_entries is not None:
+            self.conn.execute('delete from lookups where rowid in (select rowid from lookups '
+                              'order by fetched_at desc limit -1 offset ?)', [self.max_entries])
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute('delete from lookups')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# Local stand-in for astroquery's SDSS client, so the batched lookups can be run
+# offline. Takes dataframes for each of the tables we query, and answers the
+# 'select ... from ... where ... in (...)' queries built above. Set latency to make
+# each query take that many seconds, as if it went over the network.
+class LocalSDSS(object):
+    _query_pattern=re.compile(r'select\s+(.+?)\s+from\s+(\w+)\s+where\s+(\w+)\s+in\s+\((.*)\)', re.I | re.S)
+
+    def __init__(self, photoobjall=None, specobjall=None, zooVotes=None, latency=0.):
+        self.tables={'photoobjall' : photoobjall,
+                     'specobjall'  : specobjall,
+                     'zooVotes'    : zooVotes}
+        self.latency=latency
+        self.queries=[] # Every query received, so callers can count round-trips
+
+    def query_sql(self, sql):
+        self.queries.append(sql)
+        if self.latency:
+            time.sleep(self.latency)
+        match=self._query_pattern.match(sql.strip())
+        if match is None:
+            raise ValueError('LocalSDSS cannot parse query: '+sql)
+        cols,table,id_col,ids=match.groups()
+        data=self.tables.get(table)
+        if data is None or len(data)==0:
+            return None
+        ids=[int(i) for i in ids.split(',') if i.strip()]
+        rows=data.loc[data[id_col].astype('int64').isin(ids), [c.strip() for c in cols.split(',')]]
+        if len(rows)==0:
+            return None
+        return _LocalTable(rows.reset_index(drop=True))
+
+class _LocalTable(object):
+    # Mimics the one method of astropy's Table that we use
+    def __init__(self, df):
+        self._df=df
+
+    def to_pandas(self):
+        return self._df.copy()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts and modules live in the top level of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,103 @@
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from canvas_client import CanvasClient, FakeCanvasSession, FakeResponse, _should_retry
+
+# Runs the Canvas client against FakeCanvasSession, so nothing goes over the network
+
+def make_students(n):
+    return [{'user' : {'id' : 1000+i, 'sortable_name' : 'Student{0}, Test'.format(i)}, 'group_ids' : [i%7]}
+            for i in range(n)]
+
+def make_client(n_students=5, **kwargs):
+    session=FakeCanvasSession(make_students(n_students), **kwargs)
+    return CanvasClient('token', session=session, backoff=0.), session
+
+def get_requests(session):
+    return [r for r in session.requests if r[0]=='GET']
+
+def test_pagination():
+    # Every page is fetched whether Canvas sends a 'last' link (the pages after the
+    # first are fetched at once) or only 'next' links (followed one at a time)
+    for send_last_link in [True, False]:
+        for n_students in [0, 100, 250]:
+            client,session=make_client(n_students, send_last_link=send_last_link)
+            students=client.get_students(0)
+            assert students==make_students(n_students)
+            assert len(get_requests(session))==max(1, (n_students+99)//100)
+
+def test_roster_is_cached():
+    client,session=make_client(250)
+    user_ids=client.get_user_ids(0)
+    assert user_ids['Student249, Test']==1249
+    client.get_students(0)
+    assert len(get_requests(session))==3
+
+def test_requests_time_out():
+    client,session=make_client(250)
+    client.timeout=(1., 2.)
+    client.get_students(0)
+    client.send_messages([(1000, 'subject', 'body')])
+    assert all(r[3]==(1., 2.) for r in session.requests)
+
+def test_failed_gets_are_retried():
+    client,session=make_client(250, get_errors=[502, reset, requests.ReadTimeout()])
+    assert client.get_students(0)==make_students(250)
+    assert len(get_requests(session))==6
+
+def connection_error(reason):
+    # A requests.ConnectionError like the ones requests raises, wrapping urllib3's error
+    return requests.ConnectionError(MaxRetryError(None, '/api/v1/conversations', reason))
+
+refused=connection_error(NewConnectionError(None, 'connection refused'))
+reset=connection_error(Exception('connection reset by peer'))
+
+def test_throttled_posts_are_retried():
+    client,session=make_client(post_errors=[429, 403])
+    stats=client.send_messages([(1000, 'subject', 'body')])
+    assert stats.failures==[]
+    assert len(session.conversations)==1
+    assert len([r for r in session.requests if r[0]=='POST'])==3
+
+def test_posts_that_may_have_gone_through_are_not_retried():
+    for error in [502, 504, reset]:
+        client,session=make_client(post_errors=[error])
+        stats=client.send_messages([(1000, 'subject', 'body')])
+        assert len(stats.failures)==1
+        assert len([r for r in session.requests if r[0]=='POST'])==1
+
+def test_posts_that_never_connected_are_retried():
+    client,session=make_client(post_errors=[refused, requests.ConnectTimeout()])
+    stats=client.send_messages([(1000, 'subject', 'body')])
+    assert stats.failures==[]
+    assert len(session.conversations)==1
+
+def test_retry_statuses():
+    rate_limited=FakeResponse(403, {'errors' : [{'message' : 'Rate Limit Exceeded'}]})
+    forbidden=FakeResponse(403, {'errors' : [{'message' : 'user not authorized'}]})
+    maintenance=FakeResponse(503, {}, headers={'Retry-After' : '30'})
+    for method in ['get', 'post']:
+        assert _should_retry(FakeResponse(429, {}), method)
+        assert _should_retry(rate_limited, method)
+        assert not _should_retry(forbidden, method)
+        assert _should_retry(maintenance, method)
+    assert _should_retry(FakeResponse(503, {}), 'get')
+    assert not _should_retry(FakeResponse(503, {}), 'post')
+    assert _should_retry(FakeResponse(502, {}), 'get')
+    assert not _should_retry(FakeResponse(502, {}), 'post')
+
+def test_bulk_messages():
+    # Identical messages are sent as bulk conversations of at most max_recipients
+    client,session=make_client()
+    messages=[(1000+i, 'Peer reviews', 'same body') for i in range(250)]+[(5000, 'Peer reviews', 'other body')]
+    stats=client.send_messages(messages)
+    assert (stats.conversations, stats.recipients, stats.failures)==(4, 251, [])
+    recipients=sorted(len([v for k,v in data if k=='recipients[]']) for data in session.conversations)
+    assert recipients==[1, 50, 100, 100]
+    for data in session.conversations:
+        assert (('bulk_message', 'true') in data)==(len([k for k,v in data if k=='recipients[]'])>1)
+
+def test_dry_run():
+    client,session=make_client()
+    stats=client.send_messages([(1000, 'subject', 'body'), (1001, 'subject', 'body')], dry_run=True)
+    assert (stats.conversations, stats.recipients)==(1, 2)
+    assert session.requests==[]
@@ -0,0 +1,111 @@
+import sqlite3
+import pytest
+import pandas as pd
+import GalaxyZooDataExport as gz
+import make_synthetic_exports as synthetic
+from sdss_queries import get_sdss_data, lookups, QueryExecutor, LocalSDSS, SDSSQueryError
+
+# Runs the Galaxy Zoo export end to end on a small synthetic export, with SDSS
+# answered by a LocalSDSS
+
+photoobjall=pd.DataFrame({'objid' : [1, 2], 'modelmag_g' : [15., 16.], 'modelmag_r' : [14., 15.]})
+
+def make_export(tmpdir, n_rows=400, n_subjects=20):
+    synthetic.make_exports(str(tmpdir), n_rows, n_subjects)
+    return str(tmpdir.join(synthetic.gzoo_file))
+
+def run_export(tmpdir, infile):
+    return gz.main(infile=infile, workflow_outfile=str(tmpdir.join('workflow.csv')),
+                   zoo_outfile=str(tmpdir.join('zoo.csv')), sdss_cache_file=None,
+                   sdss_client=synthetic.load_local_sdss(str(tmpdir)), incremental=False,
+                   parquet_cache_dir=None, parse_workers=None, report_file=None, profile_file=None)
+
+def test_one_row_per_subject(tmpdir):
+    infile=make_export(tmpdir)
+    workflow_results,zoo_results=run_export(tmpdir, infile)
+    n_subjects=pd.read_csv(infile).query('workflow_name==@gz.workflow_name')['subject_ids'].nunique()
+    assert len(workflow_results)==len(zoo_results)==n_subjects
+
+def test_subjects_showing_the_same_galaxy(tmpdir):
+    # A subject uploaded again gets a new subject id, but shows the same galaxy
+    infile=make_export(tmpdir)
+    export=pd.read_csv(infile)
+    copies=export.loc[export['subject_ids']==export['subject_ids'].iloc[0]].copy()
+    copies['subject_data']=copies['subject_data'].str.replace(str(copies['subject_ids'].iloc[0]), '999999', n=1)
+    copies['subject_ids']=999999
+    copies['classification_id']+=export['classification_id'].max()
+    pd.concat([export, copies]).to_csv(infile, index=False)
+
+    workflow_results,zoo_results=run_export(tmpdir, infile)
+    gx_id=copies['subject_data'].str.extract(r'"(\d+)\.jpeg"')[0].iloc[0]
+    rows=workflow_results.loc[workflow_results['Galaxy ID']==gx_id]
+    assert len(rows)==2
+    assert rows['g_mag'].nunique()==1
+    assert len(zoo_results.loc[zoo_results['Galaxy ID']==gx_id])==2
+
+def test_sdss_data_has_one_row_per_objid():
+    client=LocalSDSS(photoobjall=photoobjall)
+    data=get_sdss_data(['1', '2', '1'], client=client, executor=QueryExecutor(max_workers=1, rate=None))
+    assert list(data.index)==['1', '2']
+    assert data.loc['1', 'modelmag_g']==15.
+
+class FlakySDSS(LocalSDSS):
+    # A LocalSDSS whose first `failures` queries raise error instead of answering
+    def __init__(self, error, failures, **tables):
+        LocalSDSS.__init__(self, **tables)
+        self.error=error
+        self.failures=failures
+
+    def query_sql(self, sql):
+        if self.failures:
+            self.failures-=1
+            raise self.error
+        return LocalSDSS.query_sql(self, sql)
+
+def test_network_errors_are_retried():
+    client=FlakySDSS(IOError('connection reset'), 2, photoobjall=photoobjall)
+    executor=QueryExecutor(max_workers=1, rate=None, max_retries=2, backoff=0.)
+    data=get_sdss_data(['1', '2'], client=client, executor=executor)
+    assert executor.stats.retries==2
+    assert list(data['modelmag_g'])==[15., 16.]
+
+def test_failed_lookups_raise():
+    client=FlakySDSS(IOError('connection reset'), 100, photoobjall=photoobjall)
+    executor=QueryExecutor(max_workers=1, rate=None, max_retries=1, backoff=0.)
+    with pytest.raises(SDSSQueryError) as error:
+        get_sdss_data(['1', '2'], client=client, executor=executor)
+    assert set(error.value.failed_ids)==set(lookups)
+
+    client=FlakySDSS(IOError('connection reset'), 2, photoobjall=photoobjall)
+    executor=QueryExecutor(max_workers=1, rate=None, max_retries=1, backoff=0.)
+    data=get_sdss_data(['1', '2'], client=client, executor=executor, allow_failures=True)
+    assert executor.stats.failed_ids=={'mags' : ['1', '2']}
+    assert data['modelmag_g'].isnull().all()
+
+def test_other_errors_are_not_retried():
+    client=FlakySDSS(ValueError('bad query'), 1, photoobjall=photoobjall)
+    executor=QueryExecutor(max_workers=1, rate=None, max_retries=4, backoff=0.)
+    with pytest.raises(ValueError):
+        get_sdss_data(['1', '2'], client=client, executor=executor)
+    assert executor.stats.retries==0
+
+def test_export_stops_when_lookups_fail(tmpdir):
+    infile=make_export(tmpdir)
+    client=FlakySDSS(IOError('SkyServer is down'), 100)
+    with pytest.raises(SDSSQueryError):
+        gz.main(infile=infile, workflow_outfile=str(tmpdir.join('workflow.csv')),
+                zoo_outfile=str(tmpdir.join('zoo.csv')), sdss_cache_file=None, sdss_client=client,
+                sdss_max_retries=0, incremental=False, parquet_cache_dir=None, parse_workers=None,
+                report_file=None, profile_file=None)
+    assert not tmpdir.join('workflow.csv').exists()
+
+def test_sdss_cache_eviction(tmpdir):
+    infile=make_export(tmpdir)
+    cache_file=str(tmpdir.join('sdss_cache.sqlite'))
+    gz.main(infile=infile, workflow_outfile=str(tmpdir.join('workflow.csv')),
+            zoo_outfile=str(tmpdir.join('zoo.csv')), sdss_cache_file=cache_file, sdss_cache_max_entries=10,
+            sdss_client=synthetic.load_local_sdss(str(tmpdir)), incremental=False, parquet_cache_dir=None,
+            parse_workers=None, report_file=None, profile_file=None)
+    conn=sqlite3.connect(cache_file)
+    assert conn.execute('select count(*) from lookups').fetchone()[0]==10
+    conn.close()
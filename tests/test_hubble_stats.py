@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+from HubbleLawDataReduction import get_galaxy_stats
+
+# Checks the per-galaxy Hubble's law stats against values worked out by hand
+
+def make_marks(lambdacen):
+    return pd.DataFrame({'galaxy_id' : 1, 'ra' : 10., 'dec' : 20., 'z' : 0.05, 'lambdacen' : lambdacen})
+
+def test_robust_stats_after_clipping():
+    # 500 is thrown out, leaving 400-404 with a median of 402 and absolute deviations
+    # of 2, 1, 0, 1, 2 from it
+    stats = get_galaxy_stats(make_marks([400., 401., 402., 403., 404., 500.]), robust=True, clip_sigma=3.)
+    assert stats['N Class'].iloc[0] == 5
+    assert stats['lambda_av'].iloc[0] == 402.
+    assert np.isclose(stats['lambda_err'].iloc[0], 1.4826)
+
+def test_mean_stats_after_clipping():
+    stats = get_galaxy_stats(make_marks([400., 401., 402., 403., 404., 500.]), clip_sigma=3.)
+    assert stats['lambda_av'].iloc[0] == 402.
+    assert np.isclose(stats['lambda_err'].iloc[0], np.std([400., 401., 402., 403., 404.], ddof=1))
@@ -0,0 +1,24 @@
+import intro2astro
+
+# Checks that the command line turns its options into the right settings for each
+# script's main()
+
+def get_settings(argv):
+    return intro2astro.get_settings(intro2astro.make_parser().parse_args(argv))
+
+def test_options_left_out_keep_the_script_settings():
+    assert get_settings(['gzoo'])=={}
+    assert get_settings(['hubble', '--incremental'])=={'incremental' : True}
+    assert get_settings(['zoo-tools', '--no-with-distance'])=={'with_distance' : False}
+
+def test_sdss_cache():
+    assert get_settings(['gzoo', '--sdss-cache', 'none'])=={'sdss_cache_file' : None}
+    assert get_settings(['gzoo', '--sdss-cache', 'cache.sqlite', '--sdss-cache-max-age', '30'])=={
+        'sdss_cache_file' : 'cache.sqlite', 'sdss_cache_max_age_days' : 30.}
+
+def test_peer_review_source(monkeypatch):
+    monkeypatch.delenv('CANVAS_AUTH_TOKEN', raising=False)
+    assert get_settings(['peer-review', '--students', 'groups.csv'])=={'filename' : 'groups.csv', 'use_canvas' : False}
+    monkeypatch.setenv('CANVAS_AUTH_TOKEN', 'token')
+    assert get_settings(['peer-review', '--course-id', '5'])=={'course_id' : 5, 'use_canvas' : True,
+                                                               'canvas_auth_token' : 'token'}
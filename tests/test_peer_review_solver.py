@@ -0,0 +1,45 @@
+import random
+import pytest
+from peer_review_solver import assign_reviews
+from peer_review_stats import validate_assignments
+
+# Checks the solver's assignments on random group layouts, and that it reports layouts
+# that can't be solved
+
+def make_students(sizes):
+    return [('Student{0}_{1}, Test'.format(g, i), g+1) for g,size in enumerate(sizes) for i in range(size)]
+
+def test_random_layouts():
+    for trial in range(200):
+        rnd=random.Random(trial)
+        reviews_per_student=rnd.randint(1, 3)
+        sizes=[rnd.randint(1, 8) for _ in range(rnd.randint(reviews_per_student+3, 15))]
+        students=make_students(sizes)
+        results=assign_reviews(students, reviews_per_student, seed=trial)
+        assert [(name, group) for name,group,_ in results]==students
+        report=validate_assignments(results, reviews_per_student)
+        assert report['valid'], (sizes, reviews_per_student, report)
+        assert report['num_groups']==len(sizes)
+
+def test_large_class():
+    students=make_students([5]*1000)
+    report=validate_assignments(assign_reviews(students, 2, seed=1), 2)
+    assert report['valid']
+    assert (report['load']['min'], report['load']['max'])==(10, 10)
+
+def test_seed():
+    students=make_students([4, 5, 3, 6, 2])
+    assert assign_reviews(students, 2, seed=5)==assign_reviews(students, 2, seed=5)
+
+def test_infeasible_layouts():
+    # One group is so big that the other groups' students can't review its video as
+    # often as every other video gets reviewed
+    with pytest.raises(ValueError):
+        assign_reviews(make_students([20, 1, 1, 1]), 2, seed=0)
+    # With 4 groups and 3 reviews each, every student reviews every other group, so
+    # groups of different sizes can't be reviewed evenly
+    with pytest.raises(ValueError):
+        assign_reviews(make_students([6, 5, 7, 2]), 3, seed=0)
+    # Not enough groups
+    with pytest.raises(ValueError):
+        assign_reviews(make_students([4, 4]), 2, seed=0)
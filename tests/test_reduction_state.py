@@ -0,0 +1,38 @@
+import pandas as pd
+import make_synthetic_exports as synthetic
+import HubbleLawDataReduction as hub
+import intro_to_zoo_tools_data_reduction as zt
+from reduction_state import ReductionState
+
+# Checks that incremental runs give the same results as full runs, and start over
+# when a setting that changes the results is changed
+
+def test_state_is_ignored_when_settings_change(tmpdir):
+    state=ReductionState(str(tmpdir), 'test', 'workflow', 'export.csv', {'start_time' : '2016-10-24 01:00'})
+    state.save(pd.DataFrame({'n' : [1]}), [5])
+    assert ReductionState(str(tmpdir), 'test', 'workflow', 'export.csv', {'start_time' : '2016-10-24 01:00'}).last_id==5
+    assert ReductionState(str(tmpdir), 'test', 'workflow', 'export.csv', {'start_time' : None}).last_id is None
+    assert ReductionState(str(tmpdir), 'test', 'workflow', 'other.csv', {'start_time' : '2016-10-24 01:00'}).last_id is None
+
+def run_zoo_tools(tmpdir, with_distance, incremental=True):
+    return zt.main(infile=str(tmpdir.join(synthetic.zoo_tools_file)), outfile=str(tmpdir.join('zoo_tools.csv')),
+                   incremental=incremental, state_dir=str(tmpdir.join('state')), parquet_cache_dir=None,
+                   with_distance=with_distance, parse_workers=None, report_file=None, profile_file=None)
+
+def test_zoo_tools_with_distance_changed(tmpdir):
+    synthetic.make_zoo_tools_export(str(tmpdir.join(synthetic.zoo_tools_file)), 300)
+    run_zoo_tools(tmpdir, False)
+    results=run_zoo_tools(tmpdir, True)
+    pd.testing.assert_frame_equal(results, run_zoo_tools(tmpdir, True, incremental=False))
+
+def run_hubble(tmpdir, start_time, incremental=True):
+    return hub.main(infile=str(tmpdir.join(synthetic.hubble_file)), outfile=str(tmpdir.join('hubble.csv')),
+                    incremental=incremental, state_dir=str(tmpdir.join('state')), parquet_cache_dir=None,
+                    robust_stats=False, clip_sigma=None, parse_workers=None, start_time=start_time,
+                    end_time=None, report_file=None, profile_file=None)
+
+def test_hubble_time_window_changed(tmpdir):
+    synthetic.make_hubble_export(str(tmpdir.join(synthetic.hubble_file)), 500, 20)
+    run_hubble(tmpdir, None)
+    results=run_hubble(tmpdir, '2016-11-15')
+    pd.testing.assert_frame_equal(results, run_hubble(tmpdir, '2016-11-15', incremental=False), rtol=1e-9)